@@ -1,3 +1,3 @@
 
 #no instruction necessar?
-__all__ = ["afs", "dar", "gmp", "ptg"]
+__all__ = ["afs", "dar", "gmp", "ptg", "common", "cache", "manifest", "instrument"]
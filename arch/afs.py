@@ -1,57 +1,238 @@
 import os, sys, os.path
 from struct import *
+from concurrent.futures import ThreadPoolExecutor
+if not __package__: # run as a script, find the arch package
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from arch import instrument
+from arch.common import MemberMapping, EntryTable, uint32Columns, readPrefix, createFile, mapFile, unmapFile, copyRange, copyRangeCRC, crcRange, readRange
 
 
-class AFS_File:
-    """Class representing an AFS container file object."""
-    def __init__(self, infile):
+_alignment = 0x800 # of member data and the filename table
+
+
+class AFS_File(MemberMapping):
+    """Class representing an AFS container file object.
+
+    Also a read-only mapping of member names (or indices) to member bytes, see arch.common.MemberMapping."""
+    def __init__(self, infile=None, mmap=False, *, create=None):
         """Takes file object, returns AFS_File object.
 
-        infile: file object, usually obtained via open command. Must be at least "rb" mode"""
+        infile: file object, usually obtained via open command. Must be at least "rb" mode, "r+b" for replaceFile.
+        mmap: map the file into memory, so memberView can hand out members without copying them.
+        create: a filename to write a new AFS file to instead, see addFile and addFiles. Written on close."""
+        self.mapping = self.view = None
+        if infile is None: # make an AFS file
+            self.outfile = open(create, "wb")
+            self.infile = None
+            self.AFSFileName = os.path.basename(create)
+            self.fpath = os.path.abspath(create)
+            self.fileCount = 0
+            self._added = [] # (name, source, size, u) per file added
+            return
+        self.outfile = None
         self.AFSFileName = os.path.basename(infile.name)
         self.fpath = os.path.abspath(infile.name)
         if not AFS_File.isAFSFile(infile):
             pass #we need to throw some sort of agreed upon error here
-        infile.seek(4)
-        self.fileCount = unpack("<I", infile.read(4))[0]
-        self.fileInfo = []
-        # get each file's offset and size
-        for i in range(self.fileCount):
-            self.fileInfo.append({})
-            self.fileInfo[i]["dataOffset"], self.fileInfo[i]["dataRunLength"] = unpack("<II", infile.read(8))
-        fileNamesOffset, fileNamesRunLength = unpack("<II", infile.read(8))
-        infile.seek(fileNamesOffset)
-        for i in range(self.fileCount):
-            self.fileInfo[i]["fileName"] = infile.read(32).strip(b"\0").decode('ascii')
-            self.fileInfo[i]["u"] = unpack("<IIII", infile.read(16))
+        with instrument.stage("afs.parse"):
+            infile.seek(4)
+            self.fileCount = unpack("<I", infile.read(4))[0]
+            # get each file's offset and size, followed by the filename table's, in one read
+            table = infile.read(8 * self.fileCount + 8)
+            if len(table) != 8 * self.fileCount + 8:
+                raise error("AFS offset table is truncated")
+            fileNamesOffset, fileNamesRunLength = unpack_from("<II", table, 8 * self.fileCount)
+            infile.seek(fileNamesOffset)
+            # the filename table stays as is, names are cut out of it when asked for
+            self._nameTable = infile.read(48 * self.fileCount)
+            if len(self._nameTable) != 48 * self.fileCount:
+                raise error("AFS filename table is truncated")
+            # everything else is kept in columns, rather than a dict per file
+            self._offsets, self._sizes = uint32Columns(table[:-8], 2)
+            self._u = uint32Columns(self._nameTable, 12)[8:]
+            self._namesOffset = fileNamesOffset
+        self.fileInfo = EntryTable(self._entry, self.fileCount)
         self.infile = infile
-    def extractFiles(self, outputdirectory=None, extrainfo=False):
+        self.mapping, self.view = mapFile(infile) if mmap else (None, None)
+    def extractFiles(self, outputdirectory=None, extrainfo=False, cache=None, manifest=None):
         """Extracts all files within to outputdirectory.
         
         outputdirectory: if not provided, will create new folder in current working directory.
-        extrainfo: prints out status while processing file."""
+        extrainfo: prints out status while processing file, by listening with arch.instrument.printEvent meanwhile.
+        cache: an arch.cache.ExtractCache to reuse earlier extractions from, saved when done.
+        manifest: an arch.manifest.ExtractManifest of earlier extractions, to skip files that haven't changed. Saved when done."""
         if outputdirectory is None:
             outputdirectory = self.AFSFileName.split(".")[0] + "_files"
         os.makedirs(outputdirectory, exist_ok=True)
-        for i in range(self.fileCount):
-            self.extractFile(i, outputdirectory=outputdirectory)
-            if extrainfo:
-                print("Outputting %s as %08X_%s to %s" % (self.fileInfo[i]["fileName"], self.fileInfo[i]["dataOffset"], self.fileInfo[i]["fileName"], outputdirectory)) 
-    def extractFile(self, fileindex, outputdirectory='.', initialindex=0):
+        printing = extrainfo and instrument.printEvent not in instrument.listeners
+        if printing:
+            instrument.listen(instrument.printEvent)
+        try:
+            for i in range(self.fileCount):
+                self.extractFile(i, outputdirectory=outputdirectory, cache=cache, manifest=manifest)
+        finally:
+            if printing:
+                instrument.unlisten(instrument.printEvent)
+        if cache is not None:
+            cache.save()
+        if manifest is not None:
+            manifest.save()
+    def extractFile(self, fileindex, outputdirectory='.', initialindex=0, cache=None, manifest=None):
         """Extracts a single file from AFS.
         
         fileindex: index number of specific file to extract.
         ourputdirectory: current working directory by default.
-        initialindex: Default zero, if default, 0 is first index, 1 is second, etc."""
+        initialindex: Default zero, if default, 0 is first index, 1 is second, etc.
+        cache: an arch.cache.ExtractCache to reuse an earlier extraction from.
+        manifest: an arch.manifest.ExtractManifest, to skip the file if it hasn't changed since it was last extracted."""
         if not 0 <= fileindex - initialindex < self.fileCount:
             raise IndexError(fileindex - initialindex)
         os.makedirs(outputdirectory, exist_ok=True)
         file = self.fileInfo[fileindex - initialindex]
-        self.infile.seek(file["dataOffset"])
-        fn = "%08X_%s" % (file["dataOffset"], file["fileName"])
-        data = self.infile.read(file["dataRunLength"])
-        with open(os.path.join(outputdirectory, fn), "wb") as oot:
-            oot.write(data)
+        fn = os.path.join(outputdirectory, "%08X_%s" % (file["dataOffset"], file["fileName"]))
+        if manifest is not None:
+            member = (self.fpath, str(fileindex - initialindex), file["dataOffset"], file["dataRunLength"], [fn],
+                      lambda: crcRange(self.infile, file["dataOffset"], file["dataRunLength"], self.view))
+            if manifest.check(*member): return
+        if cache is not None:
+            key = cache.key(self.fpath, file["dataOffset"], file["dataRunLength"])
+            if cache.fetch(key, fn, lambda: cache.storedKey(self.infile, file["dataOffset"], file["dataRunLength"], self.view)):
+                if manifest is not None: manifest.record(*member)
+                return
+        with instrument.stage("afs.write"), createFile(fn) as oot:
+            if manifest is not None: # sum the bytes on their way through, rather than reading them again
+                member = member[:5] + (copyRangeCRC(self.infile, file["dataOffset"], file["dataRunLength"], oot, self.view),)
+            else:
+                copyRange(self.infile, file["dataOffset"], file["dataRunLength"], oot, self.view)
+        instrument.count("afs.members")
+        instrument.count("afs.bytes", file["dataRunLength"])
+        instrument.event("afs.member", "Outputting %(name)s as %(file)s to %(directory)s", index=fileindex - initialindex, path=fn,
+                         name=file["fileName"], file=os.path.basename(fn), directory=outputdirectory)
+        if cache is not None:
+            cache.store(key, fn)
+        if manifest is not None:
+            manifest.record(*member)
+    def addFile(self, source, name=None, u=(0, 0, 0, 0)):
+        """Adds a file to an AFS being created. Nothing is read until the AFS is written.
+
+        source: a path, the file's contents as bytes, or (file object, offset, length) to copy out of another file.
+        name: the name to store it under, up to 32 characters. Defaults to the path's filename.
+        u: the four values after the name in the filename table."""
+        if self.outfile is None:
+            raise ValueError("AFS file wasn't opened for creation.")
+        if name is None:
+            if not isinstance(source, str):
+                raise ValueError("A name is needed for files not added from a path.")
+            name = os.path.basename(source)
+        self._added.append((_nameField(name), source, _sourceSize(source), tuple(u)))
+        self.fileCount = len(self._added)
+    def addFiles(self, paths):
+        """Adds the files at paths, under their filenames."""
+        for path in paths:
+            self.addFile(path)
+    def finish(self, workers=None):
+        """Writes an AFS being created: the offset table, the members, each at a multiple of 0x800, and the filename table.
+
+        workers: threads copying members in, defaults to the CPU count. Members are copied straight to
+        their place in the file, through the kernel where it can, and never all held in memory."""
+        if self.outfile is None or self.outfile.closed:
+            return
+        with instrument.stage("afs.pack"):
+            f, count = self.outfile, len(self._added)
+            offset = _align(16 + 8 * count)
+            table = []
+            for name, source, size, u in self._added:
+                table.append((offset, size))
+                offset = _align(offset + size)
+            f.write(b"AFS\0" + pack("<I", count))
+            f.write(b"".join(pack("<II", *entry) for entry in table))
+            f.write(pack("<II", offset, 48 * count))
+            f.seek(offset)
+            f.write(b"".join(name + pack("<IIII", *u) for name, source, size, u in self._added))
+            f.flush()
+            with ThreadPoolExecutor(workers or os.cpu_count() or 1) as pool:
+                for future in [pool.submit(_copySource, source, size, f, o) for (name, source, size, u), (o, size) in zip(self._added, table)]:
+                    future.result()
+            instrument.count("afs.packed", count)
+            f.close()
+    def replaceFile(self, key, source, u=None):
+        """Replaces the member at index or name key with source, a path, bytes or (file object, offset, length).
+
+        When it fits the space up to whatever follows the member, only that space and the member's entry are
+        rewritten. The last member always fits, the filename table after it being moved along if need be.
+        Otherwise it goes at the end of the file, and its old space is left unused. Either way only the
+        member's size (and the filename table, if moved) is copied, so a shrunk member leaves its old tail
+        behind, past the size in its entry. Needs the AFS opened with "r+b".
+        u: new values after the name in the filename table, if given.
+        Returns whether the member was replaced in place."""
+        if not self.infile.writable():
+            raise ValueError("AFS file wasn't opened for writing.")
+        i = self.memberIndex(key)
+        size, offset = _sourceSize(source), self._offsets[i]
+        f = self.infile
+        f.flush()
+        slotEnd = self._slotEnd(i)
+        inPlace = slotEnd is None or size <= slotEnd - offset
+        if not inPlace:
+            offset = _align(f.seek(0, 2))
+        with instrument.stage("afs.replace"):
+            names = None
+            if inPlace and offset <= self._namesOffset < offset + size: # the filename table is in the way
+                f.seek(8 + 8 * self.fileCount)
+                namesLength = unpack("<II", f.read(8))[1]
+                names = readRange(f, self._namesOffset, namesLength)
+            _copySource(source, size, f, offset)
+            if names is not None:
+                self._namesOffset = _align(offset + size)
+                f.seek(self._namesOffset)
+                f.write(names)
+                f.seek(8 + 8 * self.fileCount)
+                f.write(pack("<II", self._namesOffset, len(names)))
+            f.seek(8 + 8 * i)
+            f.write(pack("<II", offset, size))
+            self._offsets[i], self._sizes[i] = offset, size
+            if u is not None:
+                f.seek(self._namesOffset + 48 * i + 32)
+                f.write(pack("<IIII", *u))
+                for column, value in zip(self._u, u):
+                    column[i] = value
+            f.flush()
+            f.seek(0, 2) # drops anything read ahead from before the copy
+        instrument.event("afs.replace", "Replaced %(name)s %(how)s", name=self.memberName(i), how="in place" if inPlace else "at %08X" % offset, index=i)
+        if self.view is not None: # the mapping doesn't see the file grow
+            unmapFile(self.mapping, self.view)
+            self.mapping, self.view = mapFile(f)
+        return inPlace
+    def _slotEnd(self, i):
+        """Where the next thing in the file after member i starts, or None if it's the last member and can grow.
+
+        A filename table after the last member doesn't count, replaceFile moves it."""
+        offset = self._offsets[i]
+        starts = [o for j, o in enumerate(self._offsets) if j != i and o >= offset and self._sizes[j]]
+        if starts and self._namesOffset >= offset:
+            starts.append(self._namesOffset)
+        return min(starts) if starts else None
+    def _entry(self, i):
+        """The dict of dataOffset, dataRunLength, fileName and u that fileInfo[i] used to hold."""
+        return {"dataOffset": self._offsets[i], "dataRunLength": self._sizes[i], "fileName": self.memberName(i), "u": tuple(u[i] for u in self._u)}
+    def memberName(self, fileindex):
+        return self._nameTable[48 * fileindex:48 * fileindex + 32].strip(b"\0").decode('ascii')
+    def memberView(self, fileindex):
+        """Returns a memoryview of the stored bytes of the file at fileindex.
+
+        Without mmap mode the member is read into memory first."""
+        offset, size = self._offsets[fileindex], self._sizes[fileindex]
+        if self.view is not None:
+            return self.view[offset:offset + size]
+        self.infile.seek(offset)
+        return memoryview(self.infile.read(size))
+    def readMember(self, fileindex):
+        """Returns the bytes of the file at fileindex."""
+        offset, size = self._offsets[fileindex], self._sizes[fileindex]
+        if self.view is not None:
+            return bytes(self.view[offset:offset + size])
+        self.infile.seek(offset)
+        return self.infile.read(size)
     def info(self):
         """Prints out info about the AFS file and contained files"""
         parts = [_info_format % (self.AFSFileName, self.fileCount)]
@@ -61,21 +242,51 @@ class AFS_File:
         return ''.join(parts)
     @staticmethod
     def isAFSFile(infile):
-        """Class method for detecting if infile is an AFS file"""
-        infile.seek(0)
-        identifier = unpack("BBBB", infile.read(4))
-        if identifier == (0x41, 0x46, 0x53, 0x00):
-            return True
-        return False
+        """Class method for detecting if infile is an AFS file, leaves infile where it was"""
+        return AFS_File.probe(*readPrefix(infile, 8))
+    @staticmethod
+    def probe(prefix, size):
+        """Checks the first bytes of a file size bytes long for the AFS magic and a table that fits in the file."""
+        if len(prefix) < 8 or prefix[:4] != b"AFS\x00":
+            return False
+        return 16 + 8 * unpack_from("<I", prefix, 4)[0] <= size
 
     def close(self):
+        unmapFile(getattr(self, 'mapping', None), getattr(self, 'view', None))
+        self.mapping = self.view = None
         if getattr(self, 'infile', None) is not None:
             self.infile.close()
         if getattr(self, 'outfile', None) is not None:
-            self.outfile.close()
+            self.finish()
     def __del__(self):
         self.close()
 
+def _align(offset):
+    return (offset + _alignment - 1) // _alignment * _alignment
+
+def _nameField(name):
+    name = name.encode("ascii")
+    if len(name) > 32:
+        raise ValueError("AFS names are at most 32 characters: %r" % name)
+    return name.ljust(32, b"\0")
+
+def _sourceSize(source):
+    if isinstance(source, str):
+        return os.path.getsize(source)
+    if isinstance(source, tuple):
+        return source[2]
+    return len(source)
+
+def _copySource(source, size, outfile, dest):
+    """Copies a file to add or replace with to dest in outfile."""
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            copyRange(f, 0, size, outfile, dest=dest)
+    elif isinstance(source, tuple):
+        copyRange(source[0], source[1], size, outfile, dest=dest)
+    else:
+        copyRange(None, 0, size, outfile, memoryview(source), dest)
+
 _usage_message = """Usage: [python] %s [mode] [options] inputfile
 
 Commands:
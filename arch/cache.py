@@ -0,0 +1,201 @@
+import os, json, shutil, hashlib, errno
+from arch.common import readRange
+
+
+_hashChunk = 1 << 20
+_FICLONE = 0x40049409 # linux/fs.h
+
+
+class ExtractCache:
+    """Content-addressed cache of extracted archive members, kept on disk between runs.
+
+    Members are looked up by (archive path, member offset, stored size, archive mtime), then by a hash
+    of their stored bytes, so an identical member of another build or archive is found without being
+    decompressed or written again. They're stored once per distinct content hash.
+    Outputs are hardlinked (or reflinked, or copied) from the cache instead of being extracted again.
+    Hardlinked outputs share their data with the cache: replace them, don't edit them in place,
+    as extraction does.
+
+    Not safe to share between processes; give each worker its own cache directory."""
+    def __init__(self, directory, maxSize=8 << 30, link="hardlink"):
+        """directory: where cached members and the index live, created if needed.
+        maxSize: total bytes of cached members to keep, least recently used are evicted beyond that.
+        link: "hardlink", "reflink" or "copy", how outputs are made from cached members. Hardlinks and
+            reflinks fall back to copies where the filesystem can't make them."""
+        if link not in ("hardlink", "reflink", "copy"):
+            raise ValueError("link must be hardlink, reflink or copy, not %r" % link)
+        self.directory = directory
+        self.maxSize = maxSize
+        self.link = link
+        self.hits = self.misses = self.evictions = 0
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+        self.indexPath = os.path.join(directory, "index.json")
+        try:
+            with open(self.indexPath) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        self.keys = index.get("keys", {}) # key -> content hash
+        self.objects = index.get("objects", {}) # content hash -> [size, last use]
+        self.stored = index.get("stored", {}) # stored key -> content hash
+        self._pending = {} # key -> stored key, for members fetch missed that store will see
+        self.size = sum(o[0] for o in self.objects.values())
+        self.clock = max((o[1] for o in self.objects.values()), default=0)
+
+    @staticmethod
+    def key(fpath, offset, size):
+        """Builds the lookup key for the member of archive fpath stored at offset, size bytes long."""
+        return "%s|%X|%X|%i" % (os.path.abspath(fpath), offset, size, os.stat(fpath).st_mtime_ns)
+
+    @staticmethod
+    def storedKey(infile, offset, size, view=None, codec="raw"):
+        """Builds the content lookup key for the size stored bytes at offset in infile, read from view if given.
+
+        codec: what extraction does to the stored bytes, "raw" or "zlib", so the same bytes extracted
+        differently aren't mistaken for each other."""
+        h = hashlib.sha1()
+        if view is not None:
+            h.update(view[offset:offset + size])
+        else:
+            end = offset + size
+            while offset < end:
+                data = readRange(infile, offset, min(_hashChunk, end - offset))
+                if not data: break
+                h.update(data)
+                offset += len(data)
+        return "%s:%X:%s" % (codec, size, h.hexdigest())
+
+    def fetch(self, key, outpath, stored=None):
+        """Makes outpath from the cache if key, or failing that the member's stored bytes, have been seen before.
+        Returns whether it could.
+
+        stored: called for the member's storedKey, only if key misses."""
+        h, s = self.keys.get(key), None
+        if h not in self.objects and stored is not None:
+            s = stored()
+            h = self.stored.get(s)
+        if h not in self.objects:
+            return self._miss(key, s)
+        try:
+            self._place(self._objectPath(h), outpath)
+        except FileNotFoundError: # evicted behind our back
+            self._drop(h)
+            return self._miss(key, s)
+        self.keys[key] = h
+        self._touch(h)
+        self.hits += 1
+        return True
+
+    def store(self, key, outpath):
+        """Records the freshly extracted outpath under key, linking it to an identical cached member if there is one."""
+        h = _hashFile(outpath)
+        self.keys[key] = h
+        s = self._pending.pop(key, None)
+        if s is not None:
+            self.stored[s] = h
+        if h in self.objects:
+            self._place(self._objectPath(h), outpath)
+        else:
+            size = os.path.getsize(outpath)
+            if size > self.maxSize:
+                del self.keys[key]
+                self.stored.pop(s, None)
+                return
+            path = self._objectPath(h)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._place(outpath, path)
+            self.objects[h] = [size, 0]
+            self.size += size
+        self._touch(h)
+        self._evict()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "objects": len(self.objects), "bytes": self.size}
+
+    def save(self):
+        """Writes the index out, dropping keys whose members have been evicted."""
+        self.keys = {k: h for k, h in self.keys.items() if h in self.objects}
+        self.stored = {s: h for s, h in self.stored.items() if h in self.objects}
+        tmp = self.indexPath + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"keys": self.keys, "objects": self.objects, "stored": self.stored}, f)
+        os.replace(tmp, self.indexPath)
+
+    def _objectPath(self, h):
+        return os.path.join(self.directory, "objects", h[:2], h)
+
+    def _miss(self, key, s):
+        if s is not None:
+            self._pending[key] = s
+        self.misses += 1
+        return False
+
+    def _touch(self, h):
+        self.clock += 1
+        self.objects[h][1] = self.clock
+
+    def _drop(self, h):
+        self.size -= self.objects.pop(h)[0]
+        try:
+            os.remove(self._objectPath(h))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        if self.size <= self.maxSize:
+            return
+        for h in sorted(self.objects, key=lambda h: self.objects[h][1]):
+            self._drop(h)
+            self.evictions += 1
+            if self.size <= self.maxSize: break
+
+    def _place(self, src, dst):
+        """Makes dst a link to (or copy of) src, replacing whatever was at dst."""
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            return # already linked, and replacing a link with itself would leave tmp behind
+        tmp = dst + ".cache-tmp"
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        if not (self.link == "hardlink" and _hardlink(src, tmp)) and not (self.link != "copy" and _reflink(src, tmp)):
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.save()
+
+
+def _hashFile(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_hashChunk), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _hardlink(src, dst):
+    try:
+        os.link(src, dst)
+        return True
+    except OSError as e:
+        if e.errno == errno.ENOENT: raise
+        return False # cross-device, unsupported, too many links
+
+def _reflink(src, dst):
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+            return True
+        except OSError:
+            pass
+    os.remove(dst)
+    return False
+
+
+if __name__=="__main__":
+    pass
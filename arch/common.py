@@ -0,0 +1,301 @@
+import os, io, sys, zlib, mmap, errno, operator, threading
+from array import array
+from collections.abc import Sequence
+
+
+_copyChunk = 1 << 20
+_noCopy = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EBADF, errno.EOPNOTSUPP, errno.ENOTSUP)
+_uint32 = "I" if array("I").itemsize == 4 else "L"
+probeSize = 4096 # bytes of a file read for format detection
+_positional = hasattr(os, "pread") and hasattr(os, "pwrite")
+_seekLock = threading.Lock() # for positioned copies where there's no pread or pwrite
+
+
+class MemberMapping:
+    """Read-only, mapping-style access to archive members, mixed into the archive classes.
+
+    len(archive), archive[index or name] for a member's bytes, iteration over member names and
+    archive.open(index or name) for a file object. The archive supplies fileCount, memberName(i)
+    and readMember(i); entries are decoded as they're asked for and nothing touches the filesystem."""
+    _nameIndex = None
+
+    def __len__(self):
+        return self.fileCount
+    def __iter__(self):
+        return (self.memberName(i) for i in range(self.fileCount))
+    def __contains__(self, key):
+        try:
+            self.memberIndex(key)
+        except (KeyError, IndexError, TypeError):
+            return False
+        return True
+    def __getitem__(self, key):
+        return self.readMember(self.memberIndex(key))
+    def open(self, key):
+        """Returns a read-only file object over the member at index or name key."""
+        return io.BytesIO(self[key])
+    def memberIndex(self, key):
+        """Turns a member name or (possibly negative) index into an index. Names that repeat find the first."""
+        if isinstance(key, str):
+            if self._nameIndex is None:
+                names = {}
+                for i in range(self.fileCount):
+                    names.setdefault(self.memberName(i), i)
+                self._nameIndex = names
+            return self._nameIndex[key]
+        i = operator.index(key)
+        if i < 0:
+            i += self.fileCount
+        if not 0 <= i < self.fileCount:
+            raise IndexError(key)
+        return i
+
+
+class EntryTable(Sequence):
+    """Read-only list of per-file dicts, each built from an archive's columns when it's looked up.
+
+    Keeps code written against the old lists of dicts working; changing a dict changes nothing."""
+    def __init__(self, entry, count):
+        self._entry, self._count = entry, count
+    def __len__(self):
+        return self._count
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._entry(j) for j in range(*i.indices(self._count))]
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        return self._entry(i)
+
+
+def uint32Columns(table, width):
+    """Splits a table of little-endian records of width uint32 fields into width array columns."""
+    a = array(_uint32, table)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return [a[i::width] for i in range(width)]
+
+class SliceFile(io.RawIOBase):
+    """Read-only file object over a bytes-like object, typically a member of an archive in memory or mapped.
+
+    Archives opened on one with mmap=True work straight off the underlying buffer, without copying."""
+    def __init__(self, data, name=""):
+        self.view = memoryview(data).cast("B")
+        self.name = name
+        self._pos = 0
+    def readable(self):
+        return True
+    def seekable(self):
+        return True
+    def read(self, n=-1):
+        end = len(self.view) if n is None or n < 0 else min(self._pos + n, len(self.view))
+        data = bytes(self.view[self._pos:end])
+        self._pos = max(self._pos, end)
+        return data
+    def readall(self):
+        return self.read()
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+    def seek(self, offset, whence=0):
+        if whence == 1: offset += self._pos
+        elif whence == 2: offset += len(self.view)
+        if offset < 0:
+            raise ValueError("negative seek position %r" % offset)
+        self._pos = offset
+        return offset
+    def tell(self):
+        return self._pos
+    def close(self):
+        if not self.closed:
+            self.view.release()
+        super().close()
+
+
+def readPrefix(infile, n=probeSize):
+    """Returns (the first n bytes of infile, its size in bytes), leaving the file where it was."""
+    pos = infile.tell()
+    try:
+        size = infile.seek(0, 2)
+        infile.seek(0)
+        prefix = infile.read(n)
+    finally:
+        infile.seek(pos)
+    return prefix, size
+
+def isAsciiName(field):
+    """Whether a null padded name field holds nothing but printable ASCII."""
+    return all(0x20 <= c < 0x7F for c in field.rstrip(b"\x00"))
+
+def createFile(path):
+    """Opens path for writing as a new file, rather than truncating whatever is there.
+
+    An earlier output may be a hardlink to an arch.cache.ExtractCache object, and writing through it
+    would change the cached copy too."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return open(path, "wb")
+
+def mapFile(infile):
+    """Returns a read-only (mmap, memoryview) pair over the whole of infile, or (None, None) if it can't be mapped.
+
+    A SliceFile is already in memory, so gets (None, a view of its buffer)."""
+    if isinstance(infile, SliceFile):
+        return None, infile.view[:]
+    try:
+        fd = infile.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None, None
+    if os.fstat(fd).st_size == 0: # mmap refuses empty files
+        return None, None
+    m = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    return m, memoryview(m)
+
+def unmapFile(m, view):
+    """Releases a mapping made by mapFile. Member views handed out keep it alive until they're dropped."""
+    if view is not None:
+        view.release()
+    if m is not None:
+        try:
+            m.close()
+        except BufferError:
+            pass # someone still holds a member view, the mapping goes when they let go of it
+
+def copyRange(infile, offset, length, outfile, view=None, dest=None):
+    """Copies length bytes at offset in infile to the current position of outfile.
+
+    Uses os.copy_file_range or os.sendfile when both ends are real files, so the data never
+    passes through Python. Otherwise writes from view, a mapping of infile, if given, or falls back
+    to reading in chunks.
+
+    dest: write at this offset of outfile instead, leaving its position alone. Reads and writes are then
+    positioned, so several threads can copy out of and into the same files at once. Flush outfile first."""
+    ifd, ofd = _fileno(infile), _fileno(outfile)
+    if ifd is not None and ofd is not None:
+        if dest is None:
+            outfile.flush()
+            done = _copyFds(ifd, offset, length, ofd)
+            outfile.seek(os.lseek(ofd, 0, os.SEEK_CUR))
+        else:
+            done = _copyFds(ifd, offset, length, ofd, dest)
+            dest += done
+        offset, length = offset + done, length - done
+        if not length:
+            return
+    if dest is not None:
+        _copyAt(infile, offset, length, outfile, ofd, view, dest)
+        return
+    if view is not None:
+        outfile.write(view[offset:offset + length])
+        return
+    infile.seek(offset)
+    while length > 0:
+        data = infile.read(min(length, _copyChunk))
+        if not data: break
+        outfile.write(data)
+        length -= len(data)
+
+def copyRangeCRC(infile, offset, length, outfile, view=None, crc=0):
+    """Copies like copyRange, returning the CRC-32 of the bytes copied carried on from crc.
+
+    The data passes through Python to be summed, which costs less than copying in the kernel and
+    reading it all again for crcRange."""
+    while length > 0:
+        n = min(length, _copyChunk)
+        data = view[offset:offset + n] if view is not None else readRange(infile, offset, n)
+        n = len(data)
+        if not n: break
+        crc = zlib.crc32(data, crc)
+        outfile.write(data)
+        offset, length = offset + n, length - n
+    return crc
+
+def _copyAt(infile, offset, length, outfile, ofd, view, dest):
+    """copyRange's positioned fallback, for when the kernel won't copy."""
+    while length > 0:
+        n = min(length, _copyChunk)
+        data = view[offset:offset + n] if view is not None else readRange(infile, offset, n)
+        n = len(data)
+        if not n: break
+        if ofd is not None and _positional:
+            data, at = memoryview(data), dest
+            while data:
+                written = os.pwrite(ofd, data, at)
+                at += written
+                data = data[written:]
+        else:
+            with _seekLock:
+                outfile.seek(dest)
+                outfile.write(data)
+        offset, dest, length = offset + n, dest + n, length - n
+
+def readRange(infile, offset, length):
+    """Returns length bytes at offset in infile, without moving it where it can, so safe alongside copyRange with dest."""
+    fd = _fileno(infile)
+    if fd is not None and _positional:
+        data = os.pread(fd, length, offset)
+        while 0 < len(data) < length: # pread can come up short
+            part = os.pread(fd, length - len(data), offset + len(data))
+            if not part: break
+            data += part
+        return data
+    with _seekLock:
+        infile.seek(offset)
+        return infile.read(length)
+
+def _fileno(f):
+    try:
+        return f.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+def crcRange(infile, offset, length, view=None, crc=0):
+    """Returns the CRC-32 of length bytes at offset in infile, carried on from crc.
+
+    Reads from view, a mapping of infile, if given, otherwise in chunks."""
+    if view is not None:
+        return zlib.crc32(view[offset:offset + length], crc)
+    infile.seek(offset)
+    while length > 0:
+        data = infile.read(min(length, _copyChunk))
+        if not data: break
+        crc = zlib.crc32(data, crc)
+        length -= len(data)
+    return crc
+
+def _copyFds(ifd, offset, length, ofd, dest=None):
+    """Copies in the kernel for as long as it cooperates, returns the number of bytes copied.
+
+    dest: where to write in ofd, if not at its position. sendfile can't do that."""
+    done = 0
+    for copy in (_copyFileRange, _sendfile if dest is None else None):
+        if copy is None: continue
+        try:
+            while done < length:
+                n = copy(ifd, ofd, offset + done, length - done, None if dest is None else dest + done)
+                if not n: return done # end of input
+                done += n
+            return done
+        except OSError as e:
+            if e.errno not in _noCopy: raise
+    return done
+
+if hasattr(os, "copy_file_range"):
+    def _copyFileRange(ifd, ofd, offset, count, dest=None):
+        return os.copy_file_range(ifd, ofd, min(count, 0x7FFFF000), offset, dest)
+else:
+    _copyFileRange = None
+
+if hasattr(os, "sendfile"):
+    def _sendfile(ifd, ofd, offset, count, dest=None):
+        return os.sendfile(ofd, ifd, offset, min(count, 0x7FFFF000))
+else:
+    _sendfile = None
+
+
+if __name__=="__main__":
+    pass
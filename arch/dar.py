@@ -1,56 +1,108 @@
 import os, sys, zlib, os.path
 from struct import *
+from concurrent.futures import ThreadPoolExecutor
+if not __package__: # run as a script, find the arch package
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from arch import instrument
+from arch.common import MemberMapping, EntryTable, uint32Columns, readPrefix, isAsciiName, createFile, mapFile, unmapFile, copyRange, copyRangeCRC, crcRange
 
 
-class DAR_File:
-    def __init__(self, *, file=None, filename=None, create=None):
+_chunkSize = 1 << 20
+_alignment = 16 # of member data in files we write
+
+
+class DAR_File(MemberMapping):
+    def __init__(self, *, file=None, filename=None, create=None, mmap=False):
         """Returns DAR_File object representing a DAR container file.
 
+        Also a read-only mapping of member names (or indices) to member bytes, see arch.common.MemberMapping.
+
         Keyword Arguments:
         file: a file object created with the open command and "rb" (minimum) access.
-        filename: a filename string pointing to a DAR file, unnecessary if infile is provided."""
+        filename: a filename string pointing to a DAR file, unnecessary if infile is provided.
+        create: a filename to write a new DAR file to, see addFile and addFiles. The tables are written on close.
+        mmap: map the file into memory, so memberView can hand out members without copying them."""
+        self.mapping = self.view = None
         if file is not None or filename is not None:
             self.infile = file or open(filename, "rb")
             if not DAR_File.isDARFile(self.infile):
                 pass # we need to throw some sort of error here
             self.DARFileName = os.path.basename(self.infile.name)
             self.fpath = os.path.abspath(self.infile.name)
-            self.infile.seek(0)
-            self.fileCount, self.fileDataOffset, self.fileNamesOffset, self.fileInfoOffset = unpack("<IIII", self.infile.read(16))
-            self.fileInfo = []
-            self.longestFileName = 0
-            for i in range(self.fileCount):
-                self.infile.seek(self.fileInfoOffset + (16 * i))
-                self.fileInfo.append({})
-                filenameOffset, self.fileInfo[i]["compressedSize"], self.fileInfo[i]["fileSize"], self.fileInfo[i]["fileOffset"] = unpack("<IIII", self.infile.read(16))
-                self.infile.seek(filenameOffset)
-                if self.fileInfo[i]["compressedSize"] != 0: self.fileInfo[i]["compressed"] = True
-                else: self.fileInfo[i]["compressed"] = False
-                # if anyone knows how to read indeterminate length, null-terminated strings from a binary file better than this, please change it!
-                # possible - read all the strings in one go and split the giant string at each \x00
-                buf = bytearray()
-                c = self.infile.read(1)
-                while c and c != b'\x00':
-                    buf.extend(c)
-                    c = self.infile.read(1)
-                fileName = buf.decode(encoding='ascii')
-                self.fileInfo[i]["fileName"] = fileName
-                self.longestFileName = max(self.longestFileName, len(fileName))
+            with instrument.stage("dar.parse"):
+                self.infile.seek(0)
+                self.fileCount, self.fileDataOffset, self.fileNamesOffset, self.fileInfoOffset = unpack("<IIII", self.infile.read(16))
+                # read the descriptors and filenames in one go each, and keep them as columns and a blob
+                # rather than a dict per file
+                self.infile.seek(self.fileInfoOffset)
+                table = self.infile.read(16 * self.fileCount)
+                if len(table) != 16 * self.fileCount:
+                    raise error("DAR descriptor table is truncated")
+                self._nameOffsets, self._compressedSizes, self._fileSizes, self._fileOffsets = uint32Columns(table, 4)
+                self._readNames()
+            self.fileInfo = EntryTable(self._entry, self.fileCount)
             self.outfile = None
+            if mmap:
+                self.mapping, self.view = mapFile(self.infile)
         else: # make a DAR file
             self.outfile = open(create, "wb")
             self.infile = None
-    def extractFiles(self, directory=None):
+            self.DARFileName = os.path.basename(create)
+            self.fpath = os.path.abspath(create)
+            self.fileCount = 0
+            self._written = [] # (name, compressedSize, fileSize, fileOffset) per file added
+            self.outfile.write(bytes(16)) # header, filled in when finished
+    def _readNames(self):
+        """Reads the whole filename region, names are then looked up in it by offset."""
+        start = self.fileNamesOffset
+        # the filename region runs up to whichever table follows it, or past the last name
+        ends = [o for o in (self.fileDataOffset, self.fileInfoOffset) if o > start]
+        if ends:
+            end = min(ends)
+        else:
+            end = max(self._nameOffsets, default=start) + 0x100
+        self.infile.seek(start)
+        self._nameStart, self._nameBlob = start, self.infile.read(end - start)
+    def _name(self, offset):
+        blob, o = self._nameBlob, offset - self._nameStart
+        end = blob.find(b'\x00', o) if 0 <= o < len(blob) else -1
+        if end != -1:
+            return blob[o:end].decode(encoding='ascii')
+        # outside of (or running off the end of) the region we read
+        self.infile.seek(offset)
+        buf = bytearray()
+        while True:
+            c = self.infile.read(0x100)
+            end = c.find(b'\x00')
+            buf.extend(c if end == -1 else c[:end])
+            if not c or end != -1: break
+        return buf.decode(encoding='ascii')
+    def _entry(self, i):
+        """The dict of compressedSize, fileSize, fileOffset, compressed and fileName that fileInfo[i] used to hold."""
+        return {"compressedSize": self._compressedSizes[i], "fileSize": self._fileSizes[i], "fileOffset": self._fileOffsets[i],
+                "compressed": self._compressedSizes[i] != 0, "fileName": self.memberName(i)}
+    @property
+    def longestFileName(self):
+        return max((len(self.memberName(i)) for i in range(self.fileCount)), default=0)
+    def memberName(self, fileindex):
+        return self._name(self._nameOffsets[fileindex])
+    def extractFiles(self, directory=None, cache=None, manifest=None):
         """Extracts all files from DAR archive.
 
         Keyword Arguments:
-        directory: the directory to output the files too. If it doesn't exist, it will be created. Defaults to the DAR file's name."""
+        directory: the directory to output the files too. If it doesn't exist, it will be created. Defaults to the DAR file's name.
+        cache: an arch.cache.ExtractCache to reuse earlier extractions from, saved when done.
+        manifest: an arch.manifest.ExtractManifest of earlier extractions, to skip files that haven't changed. Saved when done."""
         if directory is None:
             directory = os.path.splitext(self.fpath)[0] or "."
         os.makedirs(directory, exist_ok=True)
         for i in range(self.fileCount):
-            self.extractFile(i, 0, directory=directory)
-    def extractFile(self, fileindex, initialindex=0, directory="."):
+            self.extractFile(i, 0, directory=directory, cache=cache, manifest=manifest)
+        if cache is not None:
+            cache.save()
+        if manifest is not None:
+            manifest.save()
+    def extractFile(self, fileindex, initialindex=0, directory=".", cache=None, manifest=None):
         """Extracts the file at fileindex.
 
         Arguments:
@@ -58,30 +110,177 @@ class DAR_File:
 
         Keyword Arguments:
         initialindex: if not using zero indexing, pass the first index here. Defaults to zero.
-        directory: where to save the extracted file. Defaults to current directory."""
+        directory: where to save the extracted file. Defaults to current directory.
+        cache: an arch.cache.ExtractCache to reuse an earlier extraction from.
+        manifest: an arch.manifest.ExtractManifest, to skip the file if it hasn't changed since it was last extracted."""
         # does this default to the CWD or the directory in which the DAR is stored - experiments are necessary!
         fi = fileindex - initialindex
-        self.infile.seek(self.fileInfo[fi]["fileOffset"])
-        fpath = os.path.join(directory, self.fileInfo[fi]["fileName"])
+        file = self.fileInfo[fi]
+        fpath = os.path.join(directory, file["fileName"])
         fname = os.path.basename(fpath)
         dpath = os.path.dirname(fpath)
-        fn = os.path.join(dpath, "%08X_%s" % (self.fileInfo[fi]["fileOffset"], fname))
+        fn = os.path.join(dpath, "%08X_%s" % (file["fileOffset"], fname))
         os.makedirs(os.path.dirname(fn), exist_ok=True)
-        if self.fileInfo[fi]["compressed"]:
+        stored = file["compressedSize"] or file["fileSize"]
+        if manifest is not None:
+            member = (self.fpath, str(fi), file["fileOffset"], stored, [fn],
+                      lambda: crcRange(self.infile, file["fileOffset"], stored, self.view))
+            if manifest.check(*member): return
+        if cache is not None:
+            key = cache.key(self.fpath, file["fileOffset"], stored)
+            codec = "zlib" if file["compressed"] else "raw"
+            if cache.fetch(key, fn, lambda: cache.storedKey(self.infile, file["fileOffset"], stored, self.view, codec)):
+                if manifest is not None: manifest.record(*member)
+                return
+        crc = [0] if manifest is not None else None # summed on the way through, rather than reading it all again
+        with instrument.stage("dar.write"), createFile(fn) as ofile:
+            if file["compressed"]:
+                try:
+                    for data in self._iterFile(file, _chunkSize, crc):
+                        ofile.write(data)
+                except zlib.error:
+                    instrument.event("dar.warning", "File at index %(fileindex)i (from initial index %(initial)i) failed to decompress despite appearing to be compressed. Outputting (compressed?) data to %(path)s",
+                                     index=fi, fileindex=fileindex, initial=initialindex, path=fn)
+                    ofile.seek(0)
+                    ofile.truncate()
+                    self._copyStored(file, ofile, crc)
+            else:
+                self._copyStored(file, ofile, crc)
+        instrument.count("dar.members")
+        instrument.count("dar.bytes", file["fileSize"])
+        instrument.event("dar.member", index=fi, path=fn)
+        if cache is not None:
+            cache.store(key, fn)
+        if manifest is not None:
+            manifest.record(*member[:5], crc[0])
+    def _copyStored(self, file, ofile, crc):
+        """Copies the stored bytes of file to ofile, summing them into crc[0] if crc is given."""
+        stored = file["compressedSize"] or file["fileSize"]
+        if crc is None:
+            copyRange(self.infile, file["fileOffset"], stored, ofile, self.view)
+        else:
+            crc[0] = copyRangeCRC(self.infile, file["fileOffset"], stored, ofile, self.view)
+    def iterFile(self, fileindex, initialindex=0, chunksize=_chunkSize):
+        """Yields the contents of the file at fileindex, decompressed if need be, in pieces of at most chunksize bytes.
+
+        Only about chunksize bytes of compressed and decompressed data are held at a time. Raises zlib.error
+        part way through if a compressed file turns out to be corrupt or truncated."""
+        yield from self._iterFile(self.fileInfo[fileindex - initialindex], chunksize)
+    def _iterFile(self, file, chunksize, crc=None):
+        """iterFile's body. crc: a one item list to sum the CRC-32 of all the stored bytes into, if given."""
+        if not file["compressed"]:
+            yield from self._iterStored(file["fileOffset"], file["fileSize"], chunksize)
+            return
+        d = zlib.decompressobj()
+        for chunk in self._iterStored(file["fileOffset"], file["compressedSize"], chunksize):
+            if crc is not None:
+                crc[0] = zlib.crc32(chunk, crc[0])
+            while chunk and not d.eof:
+                with instrument.stage("dar.decompress"):
+                    data = d.decompress(chunk, chunksize)
+                chunk = d.unconsumed_tail
+                if data:
+                    yield data
+            if d.eof and crc is None: break
+        data = d.flush()
+        if data:
+            yield data
+        if not d.eof:
+            raise zlib.error("Error -5 while decompressing data: incomplete or truncated stream")
+    def _iterStored(self, offset, size, chunksize):
+        end = offset + size
+        while offset < end:
+            n = min(chunksize, end - offset)
+            if self.view is not None:
+                chunk = self.view[offset:offset + n]
+            else:
+                self.infile.seek(offset) # other readers may have moved the file in between
+                chunk = self.infile.read(n)
+            if not chunk: break
+            yield chunk
+            offset += len(chunk)
+    def memberView(self, fileindex):
+        """Returns a memoryview of the stored (possibly compressed) bytes of the file at fileindex.
+
+        Without mmap mode the member is read into memory first."""
+        fileOffset = self._fileOffsets[fileindex]
+        size = self._compressedSizes[fileindex] or self._fileSizes[fileindex]
+        if self.view is not None:
+            return self.view[fileOffset:fileOffset + size]
+        self.infile.seek(fileOffset)
+        return memoryview(self.infile.read(size))
+    def readMember(self, fileindex):
+        """Returns the bytes of the file at fileindex, decompressed if need be.
+
+        Like extraction, a file that fails to decompress comes back as its stored bytes."""
+        data = self.memberView(fileindex)
+        if self._compressedSizes[fileindex]:
             try:
-                data = zlib.decompress(self.infile.read(self.fileInfo[fi]["compressedSize"]))
+                with instrument.stage("dar.decompress"):
+                    return zlib.decompress(data)
             except zlib.error:
-                print("File at index %i (from initial index %i) failed to decompress despite appearing to be compressed. Outputting (compressed?) data to %s" % (fileindex, initialindex, fn))
-                self.infile.seek(self.fileInfo[fi]["fileOffset"])
-                data = self.infile.read(self.fileInfo[fi]["compressedSize"])
-        else:
-            data = self.infile.read(self.fileInfo[fi]["fileSize"])
-        with open(fn, "wb") as ofile:
-            ofile.write(data)
-    def addFiles(self, *args, **kwargs):
-        pass #will likely rely on addFile() like the extraction methods do
-    def addFile(self, *args, **kwargs):
-        pass # DARS are probably the easiest to create with the least unknowns floating about them
+                pass
+        return bytes(data)
+    def addFiles(self, paths, directory=None, level=6, levels=None, workers=None):
+        """Adds the files at paths, compressing them on a pool of threads and writing them in order.
+
+        Keyword Arguments:
+        directory: names are the paths relative to this, with / separators. Defaults to the bare filenames.
+        level: zlib compression level, or None to store files uncompressed.
+        levels: optionally a function of a file's name returning its level, overriding level.
+        workers: compression threads, defaults to the CPU count. Only about twice this many files are held in memory."""
+        workers = workers or os.cpu_count() or 1
+        jobs = []
+        for path in paths:
+            name = os.path.relpath(path, directory).replace(os.sep, "/") if directory else os.path.basename(path)
+            jobs.append((path, name, levels(name) if levels else level))
+        with ThreadPoolExecutor(workers) as pool:
+            pending = []
+            for job in jobs:
+                pending.append(pool.submit(_packFile, *job))
+                if len(pending) >= 2 * workers:
+                    self._write(*pending.pop(0).result())
+            for future in pending:
+                self._write(*future.result())
+    def addFile(self, source, name=None, level=6):
+        """Adds a single file to a DAR being created.
+
+        Arguments:
+        source: a path, or the file's contents as bytes.
+
+        Keyword Arguments:
+        name: the name to store it under, including any directories. Defaults to the path's filename.
+        level: zlib compression level, or None to store it uncompressed."""
+        if name is None:
+            if not isinstance(source, str):
+                raise ValueError("A name is needed for files added from memory.")
+            name = os.path.basename(source)
+        self._write(*_packFile(source, name, level))
+    def _write(self, name, stored, fileSize, compressed):
+        if self.outfile is None:
+            raise ValueError("DAR file wasn't opened for creation.")
+        offset = (self.outfile.tell() + _alignment - 1) // _alignment * _alignment
+        self.outfile.seek(offset)
+        self.outfile.write(stored)
+        self._written.append((name, len(stored) if compressed else 0, fileSize, offset))
+        self.fileCount = len(self._written)
+    def finish(self):
+        """Writes the filename and descriptor tables and the header of a DAR being created."""
+        if self.outfile is None or self.outfile.closed:
+            return
+        f = self.outfile
+        f.seek(0, 2)
+        namesOffset = f.tell()
+        nameOffsets = []
+        for name, compressedSize, fileSize, fileOffset in self._written:
+            nameOffsets.append(f.tell())
+            f.write(name.encode("ascii") + b"\x00")
+        infoOffset = (f.tell() + 3) // 4 * 4
+        f.seek(infoOffset)
+        f.write(b"".join(pack("<IIII", nameOffset, *entry[1:]) for nameOffset, entry in zip(nameOffsets, self._written)))
+        f.seek(0)
+        f.write(pack("<IIII", len(self._written), 16, namesOffset, infoOffset))
+        f.close()
     def info(self):
         """info() -> string
         
@@ -97,16 +296,54 @@ class DAR_File:
         return ''.join(parts)
     @staticmethod
     def isDARFile(infile):
-        return False #for now
+        """Class method for detecting if infile is a DAR file, leaves infile where it was"""
+        return DAR_File.probe(*readPrefix(infile))
+    @staticmethod
+    def probe(prefix, size):
+        """Checks the first bytes of a file size bytes long for a plausible DAR header.
+
+        DARs have no magic, so this checks the header's offsets against the file size, and the first
+        descriptor and filename too if they fall within prefix."""
+        if len(prefix) < 16:
+            return False
+        count, dataOffset, namesOffset, infoOffset = unpack_from("<IIII", prefix)
+        if not count or not all(16 <= o <= size for o in (dataOffset, namesOffset, infoOffset)) or infoOffset + 16 * count > size:
+            return False
+        if infoOffset + 16 <= len(prefix):
+            nameOffset, compressedSize, fileSize, fileOffset = unpack_from("<IIII", prefix, infoOffset)
+            if nameOffset >= size or fileOffset + (compressedSize or fileSize) > size:
+                return False
+            name = prefix[nameOffset:nameOffset + 0x100].split(b"\x00", 1)[0]
+            if nameOffset < len(prefix) and (not name or not isAsciiName(name)):
+                return False
+        return True
 
     def close(self):
+        unmapFile(getattr(self, 'mapping', None), getattr(self, 'view', None))
+        self.mapping = self.view = None
         if getattr(self, 'infile', None) is not None:
             self.infile.close()
         if getattr(self, 'outfile', None) is not None:
-            self.outfile.close()
+            self.finish()
     def __del__(self):
         self.close()
 
+def _packFile(source, name, level):
+    """Reads (if source is a path) and compresses a file to add, returns (name, stored bytes, size, compressed).
+
+    Files that zlib can't shrink are stored as they are."""
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            data = f.read()
+    else:
+        data = bytes(source)
+    if level is not None:
+        with instrument.stage("dar.compress"):
+            packed = zlib.compress(data, level)
+        if len(packed) < len(data):
+            return name, packed, len(data), True
+    return name, data, len(data), False
+
 infostr_format = """DAR Container: "%s", %i files
 File Data: %0#10X, File Descriptors: %0#10X, Filenames: %0#10X
 
@@ -1,48 +1,200 @@
-import sys, os, zlib, os.path
+import sys, os, zlib, queue, os.path, threading
 from struct import *
+if not __package__: # run as a script, find the arch package
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from arch import instrument
+from arch.common import MemberMapping, EntryTable, uint32Columns, readPrefix, isAsciiName, createFile, mapFile, unmapFile, copyRange, copyRangeCRC, crcRange, readRange
 
 
-verbose = False
+_smallSize = 1 << 16 # members up to this size are read together with their neighbours
+_maxGap = 1 << 16 # bytes between members that are read through rather than skipped
+_runSize = 4 << 20 # most bytes read at once
+_queueDepth = 8 # reads waiting to be written, so at most _queueDepth * _runSize bytes are held
 
 
-class GMP_File:
-    def __init__(self, infile):
-        """Class representing the GMP archive format."""
+class GMP_File(MemberMapping):
+    def __init__(self, infile, mmap=False):
+        """Class representing the GMP archive format.
+
+        Also a read-only mapping of member names (or indices) to member bytes, see arch.common.MemberMapping.
+
+        mmap: map the file into memory, so memberView can hand out members without copying them."""
         self.GMPFileName = os.path.basename(infile.name)
         self.fpath = os.path.abspath(infile.name)
-        infile.seek(0)
-        self.fileCount, self.descriptorOffset, self.unknown0, self.unknown1 = unpack("<IIII", infile.read(16))
-        self.fileDescriptors = []
-        for i in range(self.fileCount):
-            infile.seek(self.descriptorOffset + i * 32)
-            self.fileDescriptors.append({});
-            self.fileDescriptors[i]["name"] = infile.read(20).strip(b"\0").decode('ascii')
-                #^ Should that be 0x20?
-            #Guarding against null file names:
-            if not self.fileDescriptors[i]["name"]:
-                self.fileDescriptors[i]["name"] = "f" + str(i)
-            self.fileDescriptors[i]["rl"], self.fileDescriptors[i]["offset"], self.fileDescriptors[i]["unknown"] = unpack("<III", infile.read(12))
+        with instrument.stage("gmp.parse"):
+            infile.seek(0)
+            self.fileCount, self.descriptorOffset, self.unknown0, self.unknown1 = unpack("<IIII", infile.read(16))
+            # read the descriptors in one go, names are cut out of them when asked for
+            infile.seek(self.descriptorOffset)
+            self._nameTable = infile.read(32 * self.fileCount)
+            if len(self._nameTable) != 32 * self.fileCount:
+                raise error("GMP descriptor table is truncated")
+            # and the rest is kept in columns, rather than a dict per file
+            self._sizes, self._offsets, self._unknowns = uint32Columns(self._nameTable, 8)[5:]
+        self.fileDescriptors = EntryTable(self._entry, self.fileCount)
         self.infile = infile
-    def extractFiles(self, outputdirectory=None):
+        self.mapping, self.view = mapFile(infile) if mmap else (None, None)
+    def extractFiles(self, outputdirectory=None, cache=None, manifest=None):
         """Extract all files contained within the GMP file to a folder outputdirectory.
 
         outputdirectory: a directory name or location for files. If not provided, then use f"{GMPFileName}_files".
+        cache: an arch.cache.ExtractCache to reuse earlier extractions from, saved when done.
+        manifest: an arch.manifest.ExtractManifest of earlier extractions, to skip files that haven't changed. Saved when done.
+
+        Files are read in the order they're stored rather than listed: small neighbouring files in a single
+        read, large ones copied a chunk at a time, while a thread writes out what's been read.
         """
         if outputdirectory is None:
             outputdirectory = self.GMPFileName + "_files"
+        os.makedirs(outputdirectory, exist_ok=True)
+        self._reopen()
+        names = [os.path.join(outputdirectory, self.memberName(i)) for i in range(self.fileCount)]
+        last = {fn: i for i, fn in enumerate(names)} # repeated names end up with the last file, as they did in list order
+        plan = []
+        for i in range(self.fileCount):
+            prepared = self._prepare(i, outputdirectory, cache, manifest)
+            if prepared is not None and last[prepared[0]] == i:
+                plan.append((self._offsets[i], self._sizes[i], i) + prepared)
+        plan.sort()
+        crcs = {} if manifest is not None else None
+        self._sweep(plan, crcs)
+        for offset, rl, i, fn, member, key in plan:
+            self._written(fn, member, key, cache, manifest, crcs)
+        if cache is not None:
+            cache.save()
+        if manifest is not None:
+            manifest.save()
+    def extractFile(self, fileindex, outputdirectory='.', cache=None, manifest=None):
+        """Extract the file at fileindex to outputdirectory, under its stored name.
+
+        cache: an arch.cache.ExtractCache to reuse an earlier extraction from.
+        manifest: an arch.manifest.ExtractManifest, to skip the file if it hasn't changed since it was last extracted."""
+        if not 0 <= fileindex < self.fileCount:
+            raise IndexError(fileindex)
+        self._reopen()
+        prepared = self._prepare(fileindex, outputdirectory, cache, manifest)
+        if prepared is None: return
+        fn, member, key = prepared
+        crcs = {} if manifest is not None else None
+        self._copy(fn, self._offsets[fileindex], self._sizes[fileindex], crcs)
+        self._written(fn, member, key, cache, manifest, crcs)
+    def _prepare(self, fileindex, outputdirectory, cache, manifest):
+        """Reports the file at fileindex and skips it if it's unchanged or cached, else returns (path, manifest entry, cache key)."""
+        fd = self.fileDescriptors[fileindex]
+        instrument.event("gmp.member", "Writing file %(name)s (unknown descriptor: %(unknown)08x)", index=fileindex, name=fd["name"], unknown=fd["unknown"], path=os.path.join(outputdirectory, fd["name"]))
+        fn = os.path.join(outputdirectory, fd["name"])
+        member = key = None
+        if manifest is not None:
+            member = (self.fpath, str(fileindex), fd["offset"], fd["rl"], [fn],
+                      lambda: crcRange(self.infile, fd["offset"], fd["rl"], self.view))
+            if manifest.check(*member): return None
+        if cache is not None:
+            key = cache.key(self.fpath, fd["offset"], fd["rl"])
+            if cache.fetch(key, fn, lambda: cache.storedKey(self.infile, fd["offset"], fd["rl"], self.view)):
+                if manifest is not None: manifest.record(*member)
+                return None
+        return fn, member, key
+    def _written(self, fn, member, key, cache, manifest, crcs):
+        if cache is not None:
+            cache.store(key, fn)
+        if manifest is not None:
+            manifest.record(*member[:5], crcs[fn])
+    def _copy(self, fn, offset, rl, crcs=None):
+        """Writes a file straight from the GMP, in the kernel if it can, otherwise in chunks.
+
+        crcs: a dict to put the file's CRC-32 in under fn, worked out on the way through, if given."""
+        with instrument.stage("gmp.write"), createFile(fn) as oot:
+            if crcs is None:
+                copyRange(self.infile, offset, rl, oot, self.view, 0)
+            else:
+                crcs[fn] = copyRangeCRC(self.infile, offset, rl, oot, self.view)
+        instrument.count("gmp.members")
+        instrument.count("gmp.bytes", rl)
+    def _sweep(self, plan, crcs=None):
+        """Extracts plan, (offset, size, index, path, ...) in offset order, in one pass over the file.
+
+        Runs of small files no more than _maxGap apart are read at once and handed to a writer thread as
+        slices. Large files are handed over as they are, for the writer to copy.
+        crcs: a dict to put each file's CRC-32 in by path, if given."""
+        jobs, errors = queue.Queue(_queueDepth), []
+        writer = threading.Thread(target=self._writeJobs, args=(jobs, errors, crcs), daemon=True)
+        writer.start()
+        try:
+            run = []
+            for entry in plan:
+                if errors: break
+                offset, rl = entry[0], entry[1]
+                if run and (rl > _smallSize or offset - run[-1][0] - run[-1][1] > _maxGap or offset + rl - run[0][0] > _runSize):
+                    jobs.put(self._readRun(run))
+                    run = []
+                if rl > _smallSize:
+                    jobs.put((entry[3], offset, rl))
+                else:
+                    run.append(entry)
+            if run and not errors:
+                jobs.put(self._readRun(run))
+        finally:
+            jobs.put(None)
+            writer.join()
+        if errors:
+            raise errors[0]
+    def _readRun(self, run):
+        start = run[0][0]
+        end = max(offset + rl for offset, rl, *rest in run)
+        with instrument.stage("gmp.read"):
+            data = self.view[start:end] if self.view is not None else memoryview(readRange(self.infile, start, end - start))
+        instrument.count("gmp.reads")
+        return [(entry[3], data[entry[0] - start:entry[0] - start + entry[1]]) for entry in run]
+    def _writeJobs(self, jobs, errors, crcs=None):
+        """The writer thread: writes runs of (path, bytes), and copies (path, offset, size)s, until it gets None."""
+        while True:
+            job = jobs.get()
+            if job is None: return
+            if errors: continue # keep taking jobs, so the reader isn't left waiting
+            try:
+                if isinstance(job, tuple):
+                    self._copy(*job, crcs)
+                    continue
+                for fn, data in job:
+                    with instrument.stage("gmp.write"), createFile(fn) as oot:
+                        oot.write(data)
+                    if crcs is not None:
+                        crcs[fn] = zlib.crc32(data)
+                    instrument.count("gmp.members")
+                    instrument.count("gmp.bytes", len(data))
+            except BaseException as e:
+                errors.append(e)
+    def _reopen(self):
         if self.infile.closed:
             try:
                 self.infile = open(self.fpath, 'rb')
             except IOError:
                 raise IOError(self.fpath + " was closed, and we couldn't reopen it. Quitting...")
-        os.makedirs(outputdirectory, exist_ok=True)
-        for i in range(self.fileCount):
-            self.infile.seek(self.fileDescriptors[i]["offset"])
-            filedata = self.infile.read(self.fileDescriptors[i]["rl"])
-            if verbose:
-                print("Writing file %(name)s (unknown descriptor: %(unknown)08x)" % self.fileDescriptors[i])
-            with open(os.path.join(outputdirectory, self.fileDescriptors[i]["name"]), "wb") as oot:
-                oot.write(filedata)
+    def _entry(self, i):
+        """The dict of name, rl (size), offset and unknown that fileDescriptors[i] used to hold."""
+        return {"name": self.memberName(i), "rl": self._sizes[i], "offset": self._offsets[i], "unknown": self._unknowns[i]}
+    def memberName(self, fileindex):
+        name = self._nameTable[32 * fileindex:32 * fileindex + 20].strip(b"\0").decode('ascii')
+            #^ Should that be 0x20?
+        #Guarding against null file names:
+        return name or "f" + str(fileindex)
+    def memberView(self, fileindex):
+        """Returns a memoryview of the bytes of the file at fileindex.
+
+        Without mmap mode the member is read into memory first."""
+        rl, offset = self._sizes[fileindex], self._offsets[fileindex]
+        if self.view is not None:
+            return self.view[offset:offset + rl]
+        self.infile.seek(offset)
+        return memoryview(self.infile.read(rl))
+    def readMember(self, fileindex):
+        """Returns the bytes of the file at fileindex."""
+        rl, offset = self._sizes[fileindex], self._offsets[fileindex]
+        if self.view is not None:
+            return bytes(self.view[offset:offset + rl])
+        self._reopen()
+        self.infile.seek(offset)
+        return self.infile.read(rl)
     def info(self):
         """Return a string containing information on the file represented by this object."""
         parts = [_info_format % (self.fileCount, self.descriptorOffset, self.unknown0, self.unknown1, "Filename", "Size", "Offset")]
@@ -50,7 +202,30 @@ class GMP_File:
             parts.append(_file_info_format % self.fileDescriptors[i])
         return ''.join(parts)
 
+    @staticmethod
+    def isGMPFile(infile):
+        """Detects whether infile is a GMP file, leaving infile where it was."""
+        return GMP_File.probe(*readPrefix(infile))
+    @staticmethod
+    def probe(prefix, size):
+        """Checks the first bytes of a file size bytes long for a plausible GMP header.
+
+        GMPs have no magic, so this checks the descriptor table fits in the file, and that the first
+        descriptor has a readable name and points inside the file if it falls within prefix."""
+        if len(prefix) < 16:
+            return False
+        count, descriptorOffset = unpack_from("<II", prefix)
+        if not count or descriptorOffset < 16 or descriptorOffset + 32 * count > size:
+            return False
+        if descriptorOffset + 32 <= len(prefix):
+            rl, offset = unpack_from("<II", prefix, descriptorOffset + 20)
+            if not isAsciiName(prefix[descriptorOffset:descriptorOffset + 20]) or offset + rl > size:
+                return False
+        return True
+
     def close(self):
+        unmapFile(getattr(self, 'mapping', None), getattr(self, 'view', None))
+        self.mapping = self.view = None
         if getattr(self, 'infile', None) is not None:
             self.infile.close()
         if getattr(self, 'outfile', None) is not None:
@@ -80,15 +255,16 @@ if __name__=="__main__":
         exit()
     else:
         od = ""
+        verbose = False
         filegiven = False
-        for i in range(len(sys.argv[2:])):
-            if sys.argv[i] in ['o', 'O']:
-                od = sys.argv[i+1]
-                i += 1
-            elif sys.argv[i] in ['v', 'V']:
+        args = iter(sys.argv[1:])
+        for arg in args:
+            if arg in ['o', 'O']:
+                od = next(args, "")
+            elif arg in ['v', 'V']:
                 verbose = True
             else:
-                inpath = sys.argv[i]
+                inpath = arg
                 filegiven = True
         if not filegiven:
             print(_usage_message)
@@ -96,6 +272,7 @@ if __name__=="__main__":
     with open(inpath, 'rb') as infile:
         gmp = GMP_File(infile)
         if verbose:
+            instrument.listen(instrument.printEvent)
             print(gmp.info())
             print("Extracting files...")
             print()
@@ -0,0 +1,191 @@
+"""Stage timers, counters and progress events that the archive and TPL classes report into.
+
+Nothing is kept unless a Recorder is running, and then stage() and count() cost a function call
+and a comparison each, so they're left in the hot paths:
+
+    with Recorder(profile=True) as rec:
+        TPL_File(filename="x.tpl").extractAll()
+    rec.save("x.json")
+
+Progress events go to every function passed to listen(), recording or not; printEvent prints the
+human readable messages the classes used to print themselves."""
+import json, time, threading
+
+
+listeners = []
+_recorder = None
+
+
+class _NullStage:
+    __slots__ = ()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+
+_null = _NullStage()
+
+class _Stage:
+    __slots__ = ("recorder", "name", "start")
+    def __init__(self, recorder, name):
+        self.recorder, self.name = recorder, name
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, *exc):
+        self.recorder.addTime(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def stage(name):
+    """Context manager timing a stage under name, "format.stage" by convention."""
+    r = _recorder
+    return _null if r is None else _Stage(r, name)
+
+def count(name, n=1):
+    """Adds n to counter name, such as "dar.members" or "png.bytes"."""
+    r = _recorder
+    if r is not None:
+        r.addCount(name, n)
+
+def event(name, message=None, /, **fields):
+    """Reports a progress event. message is a %-format string over fields, only formatted if anyone is listening."""
+    r = _recorder
+    if r is None and not listeners:
+        return
+    e = dict(fields, event=name, time=time.time())
+    if message is not None:
+        e["message"] = message % fields
+    if r is not None:
+        r.addEvent(e)
+    for listener in listeners:
+        listener(e)
+
+def listen(listener):
+    """Calls listener(event dict) for every event from now on."""
+    listeners.append(listener)
+
+def unlisten(listener):
+    listeners.remove(listener)
+
+def printEvent(e):
+    """A listener printing each event's message, as extraction used to."""
+    if "message" in e:
+        print(e["message"])
+
+def recorder():
+    """The running Recorder, or None."""
+    return _recorder
+
+
+class Recorder:
+    """Collects stage times, counters and events while running.
+
+    profile: also run cProfile over the thread that starts recording.
+    traceMemory: also trace allocations with tracemalloc, reporting the peak and the biggest sites.
+    maxEvents: events kept, later ones are only counted."""
+    def __init__(self, profile=False, traceMemory=False, maxEvents=10000):
+        self.profile, self.traceMemory, self.maxEvents = profile, traceMemory, maxEvents
+        self.timers = {} # name -> [calls, seconds]
+        self.counters = {}
+        self.events = []
+        self.droppedEvents = 0
+        self.elapsed = 0.0
+        self.profiler = None
+        self.memory = None
+        self._lock = threading.Lock() # stages report from worker threads too
+        self._previous = None
+        self._start = None
+
+    def start(self):
+        global _recorder
+        self._previous, _recorder = _recorder, self
+        if self.traceMemory:
+            import tracemalloc
+            tracemalloc.start()
+        if self.profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self._start = time.perf_counter()
+        return self
+
+    def stop(self):
+        global _recorder
+        self.elapsed += time.perf_counter() - self._start
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.traceMemory:
+            import tracemalloc
+            current, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics("lineno")[:20]
+            tracemalloc.stop()
+            self.memory = {"current": current, "peak": peak,
+                           "top": [{"site": str(s.traceback), "bytes": s.size, "blocks": s.count} for s in top]}
+        _recorder, self._previous = self._previous, None
+
+    def __enter__(self):
+        return self.start()
+    def __exit__(self, *exc):
+        self.stop()
+
+    def addTime(self, name, seconds):
+        with self._lock:
+            t = self.timers.get(name)
+            if t is None:
+                self.timers[name] = [1, seconds]
+            else:
+                t[0] += 1
+                t[1] += seconds
+
+    def addCount(self, name, n):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def addEvent(self, e):
+        with self._lock:
+            if len(self.events) < self.maxEvents:
+                self.events.append(e)
+            else:
+                self.droppedEvents += 1
+
+    def profileStats(self, limit=40):
+        """The limit functions with the most cumulative time, as dicts, if profiling."""
+        if self.profiler is None:
+            return None
+        import pstats
+        stats = pstats.Stats(self.profiler).stats
+        rows = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+        return [{"function": "%s:%i(%s)" % key, "calls": s[1], "total": s[2], "cumulative": s[3]} for key, s in rows]
+
+    def report(self):
+        """Everything collected, as a JSON-ready dict."""
+        with self._lock:
+            report = {"elapsed": self.elapsed,
+                      "timers": {name: {"calls": t[0], "seconds": t[1]} for name, t in sorted(self.timers.items())},
+                      "counters": dict(sorted(self.counters.items())),
+                      "events": list(self.events), "droppedEvents": self.droppedEvents}
+        if self.profiler is not None:
+            report["profile"] = self.profileStats()
+        if self.memory is not None:
+            report["memory"] = self.memory
+        return report
+
+    def save(self, path):
+        """Writes report() to path as JSON."""
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=1)
+
+    def dumpProfile(self, path):
+        """Writes the raw cProfile data to path, for pstats or snakeviz."""
+        self.profiler.dump_stats(path)
+
+    def summary(self):
+        """The timers and counters as readable lines, slowest stage first."""
+        lines = ["%-20s %8i calls %10.4fs" % (name, t[0], t[1]) for name, t in sorted(self.timers.items(), key=lambda item: -item[1][1])]
+        lines.extend("%-20s %12i" % item for item in sorted(self.counters.items()))
+        return "\n".join(lines)
+
+
+if __name__=="__main__":
+    pass
@@ -0,0 +1,84 @@
+import os, json
+
+
+class ExtractManifest:
+    """Record of what earlier extractions wrote, kept on disk so unchanged members can be skipped.
+
+    For every member extracted it keeps the archive's size and mtime at the time, the member's offset,
+    size and CRC-32 of its source bytes, and the size and mtime of each output. A member is skipped when
+    its outputs are still as written and either the archive hasn't changed since, found with a stat, or
+    its source bytes still have the same CRC.
+
+    One manifest can cover any number of archives. Not safe to share between processes."""
+    def __init__(self, path):
+        """path: the JSON file the manifest is loaded from, if it exists, and saved to."""
+        self.path = path
+        self.skipped = self.extracted = 0
+        try:
+            with open(path) as f:
+                self.archives = json.load(f).get("archives", {})
+        except (OSError, ValueError):
+            self.archives = {} # archive path -> member key -> entry
+        self._dirty = False
+
+    def check(self, fpath, key, offset, size, outputs, crc):
+        """Whether member key of archive fpath can be skipped.
+
+        offset, size: where the member's source bytes are in the archive.
+        outputs: the paths extracting it would write.
+        crc: called for the CRC-32 of the source bytes, only if the archive has changed."""
+        entry = self.archives.get(os.path.abspath(fpath), {}).get(key)
+        if entry is None or entry["offset"] != offset or entry["size"] != size:
+            return False
+        if sorted(entry["outputs"]) != sorted(os.path.abspath(p) for p in outputs):
+            return False
+        for path, stamp in entry["outputs"].items():
+            if _stamp(path) != stamp:
+                return False
+        stamp = _stamp(fpath)
+        if entry["archive"] != stamp:
+            if entry["crc"] != crc():
+                return False
+            entry["archive"] = stamp # checked against the archive as it is now, a stat will do next time
+            self._dirty = True
+        self.skipped += 1
+        return True
+
+    def record(self, fpath, key, offset, size, outputs, crc):
+        """Notes that member key of archive fpath has just been written to outputs.
+
+        crc: as for check, or the CRC-32 itself if it was worked out while extracting."""
+        members = self.archives.setdefault(os.path.abspath(fpath), {})
+        members[key] = {"offset": offset, "size": size, "crc": crc if isinstance(crc, int) else crc(), "archive": _stamp(fpath),
+                        "outputs": {os.path.abspath(p): _stamp(p) for p in outputs}}
+        self.extracted += 1
+        self._dirty = True
+
+    def save(self):
+        """Writes the manifest out, if anything was recorded since it was loaded or last saved."""
+        if not self._dirty:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"archives": self.archives}, f)
+        os.replace(tmp, self.path)
+        self._dirty = False
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.save()
+
+def _stamp(path):
+    """[size, mtime in ns] of path, or None if it's gone."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+if __name__=="__main__":
+    pass
@@ -0,0 +1,140 @@
+"""Extracts many AFS, DAR, GMP and TPL files at once, spreading their members over a process pool."""
+import os, sys, argparse, traceback
+from concurrent.futures import ProcessPoolExecutor
+from arch.afs import AFS_File
+from arch.dar import DAR_File
+from arch.gmp import GMP_File
+from graphics.tpl import TPL_File
+import formats
+
+
+_extensions = {".afs": "afs", ".dar": "dar", ".gmp": "gmp", ".tpl": "tpl"}
+_kinds = {AFS_File: "afs", DAR_File: "dar", GMP_File: "gmp", TPL_File: "tpl"}
+_openArchives = {} # per worker process, (kind, path) -> open archive object
+_maxOpenArchives = 8
+
+
+def findArchives(paths):
+    """Yields (kind, path, root) for each archive in paths, walking any directories given.
+
+    root is the directory the archive was found under, used to mirror the tree on output."""
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for fn in sorted(filenames):
+                    kind = _extensions.get(os.path.splitext(fn)[1].lower())
+                    if kind:
+                        yield kind, os.path.join(dirpath, fn), path
+        else:
+            kind = _extensions.get(os.path.splitext(path)[1].lower())
+            if kind is None: # named files get sniffed, the rest of a tree is taken by extension
+                kind = _kinds.get(formats.detect(path)) if os.path.isfile(path) else None
+            yield kind, path, os.path.dirname(path)
+
+def openArchive(kind, path):
+    if kind == "afs": return AFS_File(open(path, "rb"))
+    if kind == "dar": return DAR_File(filename=path)
+    if kind == "gmp": return GMP_File(open(path, "rb"))
+    if kind == "tpl": return TPL_File(filename=path)
+    raise ValueError("Unknown archive type for %s" % path)
+
+def members(kind, archive):
+    """Lists the extractable members of an archive, as passed to extractMember."""
+    if kind == "gmp": # repeated names would race each other across jobs, only the last one is written, as extractFiles does
+        return sorted({archive.memberName(i): i for i in range(archive.fileCount)}.values())
+    if kind != "tpl":
+        return list(range(archive.fileCount))
+    m = []
+    # the same choices TPL_File.extractAll makes
+    if (archive.spriteCount > 0 and archive.textureCount > 1) or archive.spriteCount == 0:
+        m.extend(("tex", i) for i in range(archive.textureCount) if archive.textures[i] is not archive.td)
+    if archive.spriteCount > 0 and archive.spriteData[0]['shl'] == 8:
+        m.extend(("spr", j) for j in range(archive.spriteData[0]['sCount']))
+    return m
+
+def extractMember(kind, archive, member, outputdirectory):
+    if kind == "afs": archive.extractFile(member, outputdirectory=outputdirectory)
+    elif kind == "dar": archive.extractFile(member, directory=outputdirectory)
+    elif kind == "gmp": archive.extractFile(member, outputdirectory=outputdirectory)
+    elif member[0] == "tex": archive.extractTexture(member[1], None, outputdirectory)
+    else: archive.extractSprite(member[1], None, outputdirectory)
+
+def planJobs(paths, outputdirectory=".", chunksize=16):
+    """Splits the archives in paths into jobs of at most chunksize members each.
+
+    Returns (jobs, failures), jobs being (kind, path, members, outdir) tuples for _runJob and failures
+    (path, member, error) tuples for archives that couldn't even be opened."""
+    jobs, failures = [], []
+    for kind, path, root in findArchives(paths):
+        outdir = os.path.join(outputdirectory, os.path.splitext(os.path.relpath(path, root or "."))[0])
+        try:
+            archive = openArchive(kind, path)
+            try:
+                m = members(kind, archive)
+            finally:
+                archive.close()
+        except Exception as e:
+            failures.append((path, None, "%s: %s" % (e.__class__.__name__, e)))
+            continue
+        for i in range(0, len(m), chunksize):
+            jobs.append((kind, path, m[i:i + chunksize], outdir))
+    return jobs, failures
+
+def _runJob(kind, path, members, outdir):
+    """Worker side: extracts some members of one archive, returns [(member, error or None)]."""
+    archive = _openArchives.get((kind, path))
+    if archive is None:
+        while len(_openArchives) >= _maxOpenArchives:
+            _openArchives.pop(next(iter(_openArchives))).close()
+        archive = _openArchives[kind, path] = openArchive(kind, path) # TPLs keep their decoded sheet cached
+    os.makedirs(outdir, exist_ok=True)
+    results = []
+    for member in members:
+        try:
+            extractMember(kind, archive, member, outdir)
+            results.append((member, None))
+        except Exception as e:
+            results.append((member, "%s: %s" % (e.__class__.__name__, e)))
+    return results
+
+def extractAll(paths, outputdirectory=".", workers=None, chunksize=16, progress=None):
+    """Extracts every member of every archive in paths across a pool of worker processes.
+
+    paths: archive files and/or directories to search for them.
+    workers: number of processes, defaults to the CPU count.
+    chunksize: the most members of one archive handed to a worker at a time.
+    progress: called as progress(done, total, path, members) as jobs finish, in submission order.
+
+    Returns a list of (path, member, error) for every failure."""
+    jobs, failures = planJobs(paths, outputdirectory, chunksize)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_runJob, *job) for job in jobs]
+        for n, (job, future) in enumerate(zip(jobs, futures), 1):
+            try:
+                results = future.result()
+            except Exception:
+                results = [(member, traceback.format_exc(limit=1).strip()) for member in job[2]]
+            failures.extend((job[1], member, error) for member, error in results if error)
+            if progress:
+                progress(n, len(jobs), job[1], job[2])
+    return failures
+
+def _printProgress(done, total, path, members):
+    print("[%i/%i] %s (%i members)" % (done, total, path, len(members)))
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Extract AFS, DAR, GMP and TPL files in parallel.")
+    parser.add_argument("paths", nargs="+", help="archives, or directories to search for them")
+    parser.add_argument("-o", "--output", default=".", help="directory to extract to, mirroring the input tree")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes, defaults to the CPU count")
+    parser.add_argument("-c", "--chunk", type=int, default=16, help="members per job")
+    parser.add_argument("-q", "--quiet", action="store_true", help="don't report progress")
+    args = parser.parse_args()
+    failures = extractAll(args.paths, args.output, args.jobs, args.chunk, None if args.quiet else _printProgress)
+    if failures:
+        print("%i failures:" % len(failures))
+        for path, member, error in failures:
+            print("  %s [%s]: %s" % (path, "archive" if member is None else member, error))
+        sys.exit(1)
@@ -0,0 +1,128 @@
+"""Writers for synthetic AFS, DAR, GMP and TPL files, laid out the way the readers in arch and graphics expect."""
+import random, zlib
+from struct import *
+
+
+def memberData(rng, size):
+    """Half random, half repeated bytes, so compressed formats have something to do."""
+    half = size // 2
+    return rng.randbytes(half) + bytes([rng.randrange(256)]) * (size - half)
+
+def members(count, size, seed=0):
+    """Returns count (name, data) pairs of roughly size bytes each."""
+    rng = random.Random(seed)
+    return [("file%05i.bin" % i, memberData(rng, max(1, int(size * rng.uniform(0.5, 1.5))))) for i in range(count)]
+
+def _align(n, a):
+    return (n + a - 1) // a * a
+
+def makeAFS(path, files, alignment=0x800):
+    """Writes files, a list of (name, data), as an AFS container."""
+    count = len(files)
+    offset = _align(8 + 8 * count + 8, alignment)
+    table = []
+    for name, data in files:
+        table.append((offset, len(data)))
+        offset = _align(offset + len(data), alignment)
+    with open(path, "wb") as f:
+        f.write(b"AFS\0" + pack("<I", count))
+        for entry in table:
+            f.write(pack("<II", *entry))
+        f.write(pack("<II", offset, 48 * count))
+        for (name, data), (o, size) in zip(files, table):
+            f.seek(o)
+            f.write(data)
+        f.seek(offset)
+        for i, (name, data) in enumerate(files):
+            f.write(name.encode("ascii")[:32].ljust(32, b"\0") + pack("<IIII", i, 0, 0, 0))
+
+def makeDAR(path, files, compress=True):
+    """Writes files, a list of (name, data), as a DAR container, zlib compressing them if compress."""
+    count = len(files)
+    infoOffset = 16
+    namesOffset = infoOffset + 16 * count
+    names = bytearray()
+    nameOffsets = []
+    for name, data in files:
+        nameOffsets.append(namesOffset + len(names))
+        names += name.encode("ascii") + b"\0"
+    dataOffset = _align(namesOffset + len(names), 16)
+    with open(path, "wb") as f:
+        f.write(pack("<IIII", count, dataOffset, namesOffset, infoOffset))
+        f.seek(namesOffset)
+        f.write(names)
+        descriptors = []
+        offset = dataOffset
+        for nameOffset, (name, data) in zip(nameOffsets, files):
+            stored = zlib.compress(data) if compress else data
+            f.seek(offset)
+            f.write(stored)
+            descriptors.append(pack("<IIII", nameOffset, len(stored) if compress else 0, len(data), offset))
+            offset = _align(offset + len(stored), 16)
+        f.seek(infoOffset)
+        f.write(b"".join(descriptors))
+
+def makeGMP(path, files):
+    """Writes files, a list of (name, data), as a GMP archive."""
+    count = len(files)
+    offset = _align(16 + 32 * count, 16)
+    with open(path, "wb") as f:
+        f.write(pack("<IIII", count, 16, 0, 0))
+        for name, data in files:
+            f.write(name.encode("ascii")[:20].ljust(20, b"\0") + pack("<III", len(data), offset, 0))
+            offset = _align(offset + len(data), 16)
+        for name, data in files:
+            f.seek(_align(f.tell(), 16))
+            f.write(data)
+
+def makeTPL(path, textures, sheet=None, seed=0):
+    """Writes a TPL of random textures, and optionally one sprite sheet over the last of them.
+
+    textures: list of (width, height, tFormat), tFormat 4 for 4bpp, anything else 8bpp.
+    sheet: list of cells, each a list of D-blocks (hShift, vShift, row, column, hrle, vrle)."""
+    rng = random.Random(seed)
+    count = len(textures) + (1 if sheet else 0)
+    out = bytearray(pack("<II", count, 8)) + bytes(8 * count)
+    def pad():
+        out.extend(bytes(_align(len(out), 16) - len(out)))
+    for i, (width, height, tFormat) in enumerate(textures):
+        den = 2 if tFormat == 4 else 1
+        colors = 16 if den == 2 else 256
+        pad(); tInfo = len(out); out.extend(bytes(12))
+        pad(); pInfo = len(out); out.extend(pack("<HHI", colors, 0, 0))
+        pad(); palette = len(out); out.extend(rng.randbytes(colors * 4))
+        pad(); data = len(out); out.extend(rng.randbytes(width * height // den))
+        out[tInfo:tInfo + 12] = pack("<HHHHI", height, width, 0, tFormat, data)
+        out[pInfo:pInfo + 8] = pack("<HHI", colors, 0, palette)
+        out[8 + 8 * i:16 + 8 * i] = pack("<II", tInfo, pInfo)
+    if sheet:
+        pad(); tInfo = len(out); out.extend(bytes(12))
+        pad(); base = len(out)
+        out.extend(pack("<II", 8, len(sheet)) + bytes(8 * len(sheet)))
+        for j, cell in enumerate(sheet):
+            out[base + 8 + 8 * j:base + 16 + 8 * j] = pack("<IBHB", len(out) - base, 0, 0, len(cell))
+            for hShift, vShift, row, column, hrle, vrle in cell:
+                out.extend(pack("<BBHBB", hShift, vShift >> 1, ((row << 7) & 0xFC00) | column, hrle, vrle << 2))
+        out[tInfo:tInfo + 12] = pack("<HHHHI", 0, 0, 0, 0xFFFF, base)
+        out[8 + 8 * len(textures):16 + 8 * len(textures)] = pack("<II", tInfo, 0)
+    with open(path, "wb") as f:
+        f.write(out)
+
+def spriteSheet(cells, width, height, blocks=4, seed=0):
+    """Returns cells random sprite cells of up to blocks D-blocks each, reading from a width x height texture.
+
+    The texture needs to be at least 11 rows high, to leave room for a block wrapping around. Blocks only
+    start in the first 512 rows, as many as the row field can reach."""
+    if height < 11:
+        raise ValueError("Sprite sheets need textures at least 11 rows high, not %i" % height)
+    rng = random.Random(seed)
+    sheet = []
+    for j in range(cells):
+        cell = []
+        for k in range(rng.randint(1, blocks)):
+            vrle = rng.randrange(2, min(32, height - 8))
+            # rows are stored in units of 8, in 6 bits, leave room for wraparound
+            row = rng.randrange(min((height - vrle - 9) // 8 + 1, 64)) * 8
+            cell.append((rng.randrange(64), rng.randrange(32) * 2, row, rng.randrange(min(width, 0x400)), rng.randrange(min(8, width), min(128, width + 1)), vrle))
+        sheet.append(cell)
+    return sheet
@@ -0,0 +1,118 @@
+"""Times the hot paths of the archive and TPL classes against synthetic fixtures.
+
+Run from the repository root with python -m bench.run. Results go to JSON, and a previous
+results file can be given as a baseline to flag slowdowns."""
+import os, sys, json, time, shutil, platform, argparse, tempfile
+from bench import fixtures
+from arch.afs import AFS_File
+from arch.dar import DAR_File
+from arch.gmp import GMP_File
+from graphics import tpl
+from graphics.tpl import TPL_File
+
+
+scales = {
+    # members per archive, average member size, texture size, sprite cells
+    "small": (200, 4096, 256, 100),
+    "medium": (2000, 16384, 512, 500),
+    "large": (20000, 32768, 1024, 2000),
+}
+
+
+def timeit(fn, repeat, setup=None):
+    """Runs fn repeat times, returns the best and mean wall time in seconds."""
+    times = []
+    for i in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        fn(arg) if setup else fn()
+        times.append(time.perf_counter() - start)
+    return {"best": min(times), "mean": sum(times) / len(times), "repeat": repeat}
+
+def makeFixtures(directory, scale):
+    count, size, texSize, cells = scales[scale]
+    files = fixtures.members(count, size)
+    paths = {kind: os.path.join(directory, "bench." + kind) for kind in ("afs", "dar", "gmp")}
+    fixtures.makeAFS(paths["afs"], files)
+    fixtures.makeDAR(paths["dar"], files)
+    fixtures.makeGMP(paths["gmp"], files)
+    paths["tpl8"] = os.path.join(directory, "bench8.tpl")
+    fixtures.makeTPL(paths["tpl8"], [(texSize, texSize, 5)])
+    paths["tpl4"] = os.path.join(directory, "bench4.tpl")
+    fixtures.makeTPL(paths["tpl4"], [(texSize * 2, texSize, 4)])
+    paths["sheet"] = os.path.join(directory, "sheet.tpl")
+    fixtures.makeTPL(paths["sheet"], [(texSize, texSize, 5)], fixtures.spriteSheet(cells, texSize, texSize))
+    return paths, files
+
+def benchmarks(paths, files, scratch, repeat):
+    """Yields (name, result) for every benchmark."""
+    opens = {"afs": lambda: AFS_File(open(paths["afs"], "rb")),
+             "dar": lambda: DAR_File(filename=paths["dar"]),
+             "gmp": lambda: GMP_File(open(paths["gmp"], "rb"))}
+    name = files[len(files) // 2][0]
+    for kind, opener in opens.items():
+        yield kind + ".open", timeit(lambda: opener().close(), repeat)
+        archive = opener()
+        yield kind + ".fetch", timeit(lambda: archive[name], repeat)
+        archive.close()
+        out = os.path.join(scratch, kind)
+        def extract(archive):
+            archive.extractFiles(out)
+            archive.close()
+        yield kind + ".extract", timeit(extract, repeat, lambda: (shutil.rmtree(out, ignore_errors=True), opener())[1])
+    for kind in ("tpl8", "tpl4"):
+        t = TPL_File(filename=paths[kind])
+        yield kind + ".e_t", timeit(lambda: (t.textureCache.clear(), t.e_t(0)), repeat)
+        t.close()
+    t = TPL_File(filename=paths["sheet"])
+    yield "sheet.e_s", timeit(lambda: [t.e_s(j) for j in range(t.spriteData[0]['sCount'])], repeat)
+    yield "sheet.e_ss", timeit(lambda: (t.textureCache.clear(), t.e_ss()), repeat)
+    t.close()
+
+def compare(results, baseline, threshold):
+    """Returns (name, baseline best, current best, ratio) for every benchmark more than threshold times slower."""
+    slow = []
+    for name, result in results.items():
+        if name in baseline:
+            ratio = result["best"] / baseline[name]["best"] if baseline[name]["best"] else float("inf")
+            if ratio > threshold:
+                slow.append((name, baseline[name]["best"], result["best"], ratio))
+    return slow
+
+def run(scale="small", repeat=5, directory=None):
+    """Builds the fixtures and runs every benchmark, returns the JSON-ready report."""
+    scratch = directory or tempfile.mkdtemp(prefix="dhe_bench_")
+    try:
+        paths, files = makeFixtures(scratch, scale)
+        results = {}
+        for name, result in benchmarks(paths, files, scratch, repeat):
+            results[name] = result
+            print("%-16s %10.4fs best %10.4fs mean" % (name, result["best"], result["mean"]))
+    finally:
+        if directory is None:
+            shutil.rmtree(scratch, ignore_errors=True)
+    return {"meta": {"scale": scale, "repeat": repeat, "python": platform.python_version(), "platform": platform.platform(),
+                     "numpy": getattr(tpl.numpy, "__version__", None), "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+            "results": results}
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Benchmark archive and TPL decoding on synthetic files.")
+    parser.add_argument("-s", "--scale", choices=sorted(scales), default="small")
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument("-o", "--output", help="write results as JSON here")
+    parser.add_argument("-b", "--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("-t", "--threshold", type=float, default=1.10, help="slowdown ratio to flag, default 1.10")
+    parser.add_argument("-d", "--directory", help="keep fixtures and extracted files here instead of a temporary directory")
+    args = parser.parse_args()
+    report = run(args.scale, args.repeat, args.directory)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            slow = compare(report["results"], json.load(f)["results"], args.threshold)
+        for name, before, after, ratio in slow:
+            print("SLOWER %-16s %10.4fs -> %10.4fs (x%.2f)" % (name, before, after, ratio))
+        if slow:
+            sys.exit(1)
@@ -0,0 +1 @@
+# Lets the tests import arch, graphics and the top level modules from a checkout, as the scripts do.
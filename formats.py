@@ -0,0 +1,66 @@
+"""Registry of the file formats in arch and graphics, and detection of them from the first few KB of a file."""
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from arch.common import probeSize
+from arch.afs import AFS_File
+from arch.dar import DAR_File
+from arch.gmp import GMP_File
+from graphics.tpl import TPL_File
+from graphics.gim import GIM_File
+
+
+Format = namedtuple("Format", "name cls probe extensions")
+formats = [] # checked in order, so formats with magic numbers go before those relying on sanity checks
+
+
+def register(name, cls, probe=None, extensions=()):
+    """Adds a format. probe(prefix, size) gets the first bytes of a file and its size, defaults to cls.probe."""
+    formats.append(Format(name, cls, probe or cls.probe, tuple(extensions)))
+
+def identify(prefix, size):
+    """Returns the first registered Format whose probe accepts prefix, or None."""
+    for f in formats:
+        if f.probe(prefix, size):
+            return f
+    return None
+
+def detect(path):
+    """Returns the class for the file at path, or None if it isn't any registered format."""
+    f = _detect(path)
+    return f and f.cls
+
+def detect_many(paths, workers=None):
+    """Returns [(path, class or None)] for every path, reading each file's first few KB once.
+
+    workers: threads to read with, worthwhile on network mounts. Unreadable files come back as None."""
+    paths = list(paths)
+    if workers and workers > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            found = list(pool.map(_detectQuietly, paths))
+    else:
+        found = [_detectQuietly(path) for path in paths]
+    return [(path, f and f.cls) for path, f in zip(paths, found)]
+
+def _detect(path):
+    with open(path, "rb") as infile:
+        return identify(infile.read(probeSize), os.fstat(infile.fileno()).st_size)
+
+def _detectQuietly(path):
+    try:
+        return _detect(path)
+    except OSError:
+        return None
+
+
+register("afs", AFS_File, extensions=(".afs",))
+register("gim", GIM_File, extensions=(".gim",))
+register("dar", DAR_File, extensions=(".dar",))
+register("gmp", GMP_File, extensions=(".gmp",))
+register("tpl", TPL_File, extensions=(".tpl",))
+
+
+if __name__=="__main__":
+    import sys
+    for path, cls in detect_many(sys.argv[1:]):
+        print("%s\t%s" % (cls.__name__ if cls else "unknown", path))
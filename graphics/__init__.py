@@ -1 +1 @@
-__all__ = ["ptx", "pta", "lim", "gim"]
+__all__ = ["ptx", "pta", "lim", "gim", "pngout", "atlas", "quantize"]
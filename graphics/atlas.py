@@ -0,0 +1,77 @@
+"""Rectangle packing for sprite atlases."""
+
+
+def packSkyline(sizes, width=None, padding=0):
+    """Packs rectangles into one image with the skyline bottom-left heuristic.
+
+    sizes: (width, height) of each rectangle. Empty ones are placed at (0, 0) and take no room.
+    width: the atlas width, by default the narrowest of a few candidates giving the least area.
+    padding: blank pixels left between rectangles.
+
+    Returns (positions, width, height), positions being the (x, y) of each rectangle in order."""
+    sizes = [(w, h) for w, h in sizes]
+    widest = max([w for w, h in sizes if w and h] or [0])
+    if width is not None:
+        if widest > width:
+            raise ValueError("Rectangle %i wide doesn't fit in an atlas %i wide" % (widest, width))
+        positions, height = _skyline(sizes, width, padding)
+        return positions, width, height
+    area = sum((w + padding) * (h + padding) for w, h in sizes if w and h)
+    if not area:
+        return [(0, 0)] * len(sizes), 0, 0
+    side = int(area ** 0.5)
+    candidates = sorted({max(widest, (int(side * f) + 3) & ~3) for f in (1, 1.25, 1.5, 2)})
+    best = None
+    for w in candidates:
+        result = _result(sizes, w, padding)
+        if best is None or result[1] * result[2] < best[1] * best[2]:
+            best = result
+    return best
+
+def _result(sizes, width, padding):
+    positions, height = _skyline(sizes, width, padding)
+    used = max([x + w for (x, y), (w, h) in zip(positions, sizes) if w and h] or [0])
+    return positions, used, height
+
+def _skyline(sizes, width, padding):
+    """Places rectangles tallest first, each where its top ends up lowest. Returns (positions, height)."""
+    order = sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0]))
+    binWidth = width + padding # padding only needed between rectangles, not after the last column
+    skyline = [[0, 0, binWidth]] # segments of [x, y, width], left to right
+    positions = [(0, 0)] * len(sizes)
+    height = 0
+    for i in order:
+        w, h = sizes[i]
+        if not w or not h: continue
+        w, h = w + padding, h + padding
+        best = None
+        for j, (x, _, _) in enumerate(skyline):
+            if x + w > binWidth: break
+            y, k, covered = 0, j, 0
+            while covered < w:
+                y = max(y, skyline[k][1])
+                covered += skyline[k][2]
+                k += 1
+            if best is None or (y + h, x) < best[0]:
+                best = ((y + h, x), j, x, y)
+        _, j, x, y = best
+        positions[i] = (x, y)
+        height = max(height, y + h - padding)
+        end, k, rest = x + w, j, []
+        while k < len(skyline) and skyline[k][0] < end:
+            sx, sy, sw = skyline[k]
+            if sx + sw > end:
+                rest = [[end, sy, sx + sw - end]]
+            k += 1
+        skyline[j:k] = [[x, y + h, w]] + rest
+        k = 1
+        while k < len(skyline): # merge neighbours at the same height
+            if skyline[k][1] == skyline[k - 1][1]:
+                skyline[k - 1][2] += skyline.pop(k)[2]
+            else:
+                k += 1
+    return positions, height
+
+
+if __name__=="__main__":
+    pass
@@ -6,6 +6,11 @@ class GIM_File:
     def __init__(self, infile):
         pass
 
+    @staticmethod
+    def probe(prefix, size):
+        """Checks the first bytes of a file for the GIM magic."""
+        return prefix.startswith(b"MIG.00.1PSP\x00")
+
 
 
 if __name__=="__main__":
@@ -0,0 +1,153 @@
+import os, zlib, threading
+from struct import *
+from concurrent.futures import ThreadPoolExecutor
+from arch import instrument
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+try:
+    import png
+except ImportError:
+    png = None
+
+
+def paletteBytes(palette):
+    """Flattens a palette of RGBA tuples into bytes, passing flat bytes through."""
+    if isinstance(palette, (bytes, bytearray, memoryview)):
+        return bytes(palette)
+    return bytes(c for color in palette for c in color)
+
+def encodeIndexed(width, height, pixels, palette, level=6, backend=None):
+    """Returns a palette PNG as bytes.
+
+    pixels: width*height palette indices as bytes, a bytearray, a uint8 array or a list of ints.
+    palette: flat RGBA bytes, or a list of RGBA tuples.
+    level: zlib compression level.
+    backend: "zlib" or "pillow", defaults to Pillow when it's installed."""
+    with instrument.stage("png.encode"):
+        data = _encode(width, height, pixels, palette, level, backend)
+    instrument.count("png.images")
+    instrument.count("png.bytes", len(data))
+    return data
+
+def _encode(width, height, pixels, palette, level, backend):
+    palette = paletteBytes(palette)
+    if backend == "pillow" or (backend is None and Image is not None):
+        return _encodePillow(width, height, pixels, palette, level)
+    if numpy is not None and isinstance(pixels, numpy.ndarray):
+        rows = numpy.zeros((height, width + 1), dtype=numpy.uint8) # filter type 0 in front of each row
+        rows[:, 1:] = pixels.reshape(height, width)
+        raw = rows.tobytes()
+    else:
+        pixels = pixels if isinstance(pixels, (bytes, bytearray)) else bytes(pixels)
+        raw = bytearray((width + 1) * height)
+        for y in range(height):
+            raw[y * (width + 1) + 1:(y + 1) * (width + 1)] = pixels[y * width:(y + 1) * width]
+    alpha = palette[3::4].rstrip(b"\xff")
+    chunks = [_chunk(b"IHDR", pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0)),
+              _chunk(b"PLTE", b"".join(palette[i:i + 3] for i in range(0, len(palette), 4)))]
+    if alpha:
+        chunks.append(_chunk(b"tRNS", alpha))
+    chunks.append(_chunk(b"IDAT", zlib.compress(raw, level)))
+    chunks.append(_chunk(b"IEND", b""))
+    return b"\x89PNG\r\n\x1a\n" + b"".join(chunks)
+
+def writeIndexed(path, width, height, pixels, palette, level=6, backend=None):
+    """Encodes and writes a palette PNG to path, see encodeIndexed."""
+    data = encodeIndexed(width, height, pixels, palette, level, backend)
+    with instrument.stage("png.write"), open(path, "wb") as oot:
+        oot.write(data)
+
+def readPNG(path):
+    """Reads a PNG as (width, height, pixels, palette), with Pillow or failing that pypng.
+
+    Palette images give one byte per pixel of palette indices and flat RGBA palette bytes,
+    anything else gives RGBA bytes and None."""
+    if Image is not None:
+        with Image.open(path) as img:
+            if img.mode != "P":
+                return img.width, img.height, img.convert("RGBA").tobytes(), None
+            rgb = bytes(img.getpalette() or b"")
+            n = len(rgb) // 3
+            t = img.info.get("transparency")
+            if isinstance(t, int):
+                alpha = bytes(0 if i == t else 255 for i in range(n))
+            else:
+                alpha = bytes(t or b"")[:n].ljust(n, b"\xff")
+            palette = bytearray(4 * n)
+            for c in range(3):
+                palette[c::4] = rgb[c::3]
+            palette[3::4] = alpha
+            return img.width, img.height, img.tobytes(), bytes(palette)
+    if png is None:
+        raise ImportError("Reading PNGs needs Pillow or pypng")
+    reader = png.Reader(filename=path)
+    width, height, rows, info = reader.read()
+    if info.get("palette") and info["bitdepth"] <= 8:
+        pixels = b"".join(bytes(row) for row in rows)
+        return width, height, pixels, b"".join(bytes(c) + b"\xff" * (4 - len(c)) for c in info["palette"])
+    width, height, rows, info = png.Reader(filename=path).asRGBA8()
+    return width, height, b"".join(bytes(row) for row in rows), None
+
+def _chunk(kind, data):
+    return pack(">I", len(data)) + kind + data + pack(">I", zlib.crc32(kind + data))
+
+def _encodePillow(width, height, pixels, palette, level):
+    import io
+    if not isinstance(pixels, (bytes, bytearray)):
+        pixels = pixels.tobytes() if hasattr(pixels, "tobytes") else bytes(pixels)
+    img = Image.frombuffer("P", (width, height), pixels, "raw", "P", 0, 1)
+    img.putpalette(palette, "RGBA")
+    out = io.BytesIO()
+    img.save(out, "PNG", compress_level=level)
+    return out.getvalue()
+
+
+class PNGWriterPool:
+    """Encodes and writes palette PNGs on a pool of threads.
+
+    submit blocks once maxPending images are waiting, so decoding can't run ahead and fill memory.
+    Use as a context manager, or call close(), to wait for everything to be written; the first
+    error from any write is raised then."""
+    def __init__(self, workers=None, maxPending=None, level=6, backend=None):
+        workers = workers or min(32, os.cpu_count() or 1)
+        self.level, self.backend = level, backend
+        self._pool = ThreadPoolExecutor(workers)
+        self._slots = threading.BoundedSemaphore(maxPending or 2 * workers)
+        self._error = None
+    def submit(self, path, width, height, pixels, palette):
+        """Queues an image for writing, see encodeIndexed for the arguments."""
+        if self._error is not None:
+            self.close()
+        self._slots.acquire()
+        try:
+            self._pool.submit(self._write, path, width, height, pixels, palette)
+        except BaseException:
+            self._slots.release()
+            raise
+    def _write(self, path, width, height, pixels, palette):
+        try:
+            writeIndexed(path, width, height, pixels, palette, self.level, self.backend)
+        except BaseException as e:
+            if self._error is None:
+                self._error = e
+        finally:
+            self._slots.release()
+    def close(self):
+        self._pool.shutdown(wait=True)
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__=="__main__":
+    pass
@@ -0,0 +1,80 @@
+"""Palette quantization of RGBA images, for writing them into palette formats like TPL."""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def quantize(rgba, colors=256):
+    """Reduces RGBA bytes to at most colors colors. Returns (palette indices as bytes, flat RGBA palette bytes).
+
+    Images with few enough colors keep them exactly. Others are median cut with NumPy, or quantized
+    by Pillow without it."""
+    if len(rgba) % 4:
+        raise ValueError("RGBA data isn't a whole number of pixels")
+    if numpy is not None:
+        return _quantizeArray(numpy.frombuffer(bytes(rgba), dtype="<u4"), colors)
+    exact = {}
+    for i in range(0, len(rgba), 4):
+        exact.setdefault(bytes(rgba[i:i + 4]), len(exact))
+        if len(exact) > colors: break
+    else:
+        return bytes(exact[bytes(rgba[i:i + 4])] for i in range(0, len(rgba), 4)), b"".join(exact)
+    if Image is None:
+        raise ImportError("Quantizing an image with more than %i colors needs NumPy or Pillow" % colors)
+    img = Image.frombytes("RGBA", (len(rgba) // 4, 1), bytes(rgba)).quantize(colors, Image.Quantize.FASTOCTREE)
+    return img.tobytes(), bytes(img.getpalette("RGBA"))[:4 * colors]
+
+def _quantizeArray(pixels, colors):
+    unique, inverse = numpy.unique(pixels, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    if len(unique) <= colors:
+        return inverse.astype(numpy.uint8).tobytes(), unique.astype("<u4").tobytes()
+    counts = numpy.bincount(inverse, minlength=len(unique))
+    channels = unique.astype("<u4").view(numpy.uint8).reshape(-1, 4)
+    palette = medianCut(channels, counts, colors)
+    return nearest(channels, palette)[inverse].astype(numpy.uint8).tobytes(), palette.tobytes()
+
+def medianCut(channels, counts, colors):
+    """Splits the colors (an n x 4 uint8 array, weighted by counts) into boxes, returns the weighted mean of each."""
+    boxes = [numpy.arange(len(channels))]
+    while len(boxes) < colors:
+        best, bestScore = None, 0
+        for b, box in enumerate(boxes):
+            if len(box) < 2: continue
+            c = channels[box]
+            spread = int((c.max(0).astype(int) - c.min(0)).max())
+            score = spread * int(counts[box].sum())
+            if score > bestScore:
+                best, bestScore = b, score
+        if best is None: break # every box is down to one color
+        box = boxes[best]
+        c = channels[box]
+        channel = int((c.max(0).astype(int) - c.min(0)).argmax())
+        box = box[numpy.argsort(c[:, channel], kind="stable")]
+        weights = numpy.cumsum(counts[box])
+        split = int(numpy.searchsorted(weights, weights[-1] / 2))
+        split = min(max(split, 1), len(box) - 1)
+        boxes[best:best + 1] = [box[:split], box[split:]]
+    palette = numpy.empty((len(boxes), 4), dtype=numpy.uint8)
+    for b, box in enumerate(boxes):
+        w = counts[box].astype(numpy.float64)
+        palette[b] = numpy.round((channels[box] * w[:, None]).sum(0) / w.sum())
+    return palette
+
+def nearest(channels, palette, chunk=4096):
+    """Index of the closest palette entry to each color, by squared distance over all four channels."""
+    p = palette.astype(numpy.int32)
+    out = numpy.empty(len(channels), dtype=numpy.intp)
+    for start in range(0, len(channels), chunk):
+        c = channels[start:start + chunk].astype(numpy.int32)
+        out[start:start + chunk] = ((c[:, None, :] - p[None, :, :]) ** 2).sum(2).argmin(1)
+    return out
+
+
+if __name__=="__main__":
+    pass
@@ -1,11 +1,28 @@
-import os, sys, png, os.path
+import os, sys, json, os.path
 from struct import *
+from collections import OrderedDict
+from collections.abc import Sequence
+if not __package__: # run as a script, find arch and graphics from the checkout
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from arch import instrument
+from arch.common import readPrefix, crcRange
+from graphics.pngout import PNGWriterPool, writeIndexed, paletteBytes, readPNG
+from graphics.quantize import quantize
+from graphics.atlas import packSkyline
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class TPL_DBlock:
     """How to read the image data into discrete blocks for constructing images"""
+    __slots__ = ("hShift", "vShift", "row", "column", "hrle", "vrle")
     def __init__(self, block):
         self.hShift, self.vShift, self.row, self.column, self.hrle, self.vrle = block[0], block[1] << 1, (block[2] & 0xFC00) >> 7, block[2] & 0x03FF, block[3], block[4] >> 2
+    def pack(self):
+        """The 6 bytes this block is stored as. The low bits of the vertical run length are dropped on reading."""
+        return pack("<BBHBB", self.hShift, self.vShift >> 1, (self.row << 7) | self.column, self.hrle, self.vrle << 2)
     def __str__(self):
         return "DB Block {Shift: (%i, %i), Start: (%i, %i), Runlength: (%i, %i)}" % (self.hShift, self.vShift, self.column, self.row, self.hrle, self.vrle)
     def __repr__(self):
@@ -13,13 +30,89 @@ class TPL_DBlock:
 
 # No other methodss necessary?
 
+class TPL_TextureCache:
+    """Decoded textures by texture index, least recently used dropped once they take more than maxBytes.
+
+    The texture most recently added is always kept, however big, so a sprite sheet is decoded once.
+    Cached textures are shared between callers and mustn't be modified."""
+    def __init__(self, maxBytes=64 << 20):
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+    def get(self, key, decode):
+        """Returns the texture cached under key, calling decode() to make it if it isn't."""
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        self.misses += 1
+        data = decode()
+        if numpy is not None and isinstance(data, numpy.ndarray):
+            data.flags.writeable = False
+        self._entries[key] = data
+        self.size += _sizeOf(data)
+        while self.size > self.maxBytes and len(self._entries) > 1:
+            self.size -= _sizeOf(self._entries.popitem(last=False)[1])
+        return data
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+    def __len__(self):
+        return len(self._entries)
+    def __contains__(self, key):
+        return key in self._entries
+
+class TPL_PaletteColors(Sequence):
+    """A palette's colors as 4-tuples in stored order, what textures' 'palette' used to be a list of.
+
+    Tuples are cut out of the palette's bytes as they're asked for, rather than all made when the file is opened."""
+    __slots__ = ("data",)
+    def __init__(self, data):
+        self.data = data
+    def __len__(self):
+        return len(self.data) // 4
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return tuple(self.data[4 * i:4 * i + 4])
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, TPL_PaletteColors)):
+            return list(self) == list(other)
+        return NotImplemented
+    def __repr__(self):
+        return repr(list(self))
+
+def _sizeOf(data):
+    if hasattr(data, "nbytes"):
+        return data.nbytes
+    return len(data) if isinstance(data, (bytes, bytearray)) else len(data) * 8 # a pointer per pixel in a list
+
 class TPL_File:
-    def __init__(self, *, file=None, filename=None):
+    def __init__(self, *, file=None, filename=None, create=None, cacheSize=64 << 20):
+        """create: a filename to write a new TPL file to, see addTexture, addPNG and addSpriteSheet. Written on close.
+        cacheSize: bytes of decoded textures to keep around in textureCache, shared by texture and sprite extraction."""
         #assume infile is functional
         if file is not None or filename is not None:
             self.infile = file or open(filename, "rb")
+        elif create is not None: # make a TPL file
+            self.infile = None
+            self.outfile = open(create, "wb")
+            self.TPLFileName = os.path.basename(create)
+            self.fpath = os.path.abspath(create)
+            self.textureCount = self.spriteCount = 0
+            self.textures = []
+            self.spriteData = None
+            self.td = None
+            self.textureCache = TPL_TextureCache(cacheSize)
+            self._sheets = [] # cell lists, written after the textures
+            return
         else:
-            raise NotImplementedError("Can't create blank TPL file.")
+            raise TypeError("TPL_File needs file, filename or create")
         if not TPL_File.isTPL(self.infile):
             raise ValueError("Input file isn't a TPL file.")
         self.TPLFileName = os.path.basename(self.infile.name)
@@ -28,176 +121,539 @@ class TPL_File:
         self.fileLength = self.infile.tell()
         self.infile.seek(0)
         #start processing file
-        self.textureCount, self.headerSize = unpack("<II", self.infile.read(8))
-        self.spriteCount = 0
-        self.textures = []
-        self.spriteData = None
-        self.td = None
-        for i in range(self.textureCount):
-            self.infile.seek(self.headerSize + i * 8)
-            self.textures.append(dict())
-            self.textures[i]['tInfoOffset'], self.textures[i]['pInfoOffset'] = unpack("<II", self.infile.read(8))
-            self.infile.seek(self.textures[i]['tInfoOffset'])
-            tInfo = unpack("<HHHHI", self.infile.read(12))
-            self.textures[i]['tHeight'] = tInfo[0]
-            self.textures[i]['tWidth'] = tInfo[1]
-            self.textures[i]['tFormat'] = tInfo[3] #tInfo[2] doesn't matter, I think
-            self.textures[i]['tOffset'] = tInfo[4]
-            if self.textures[i]['pInfoOffset'] != 0:
-                self.infile.seek(self.textures[i]['pInfoOffset'])
-                pInfo = dict()
-                pInfo['colors'], pInfo['u'], pInfo['offset'] = unpack("<HHI", self.infile.read(8))
-                p = []
-                self.infile.seek(pInfo['offset'])
-                c = unpack("<" + str(pInfo['colors'] * 4) + "B", self.infile.read(pInfo['colors'] * 4)) # note for writing that colors are in BGRA format
-                for j in range(pInfo['colors']):
-                    p.append((c[j*4], c[j*4+1], c[j*4+2], c[j*4+3])) # switch!
-                self.textures[i]['pInfo'] = pInfo
-                self.textures[i]['palette'] = p
-            if self.textures[i]['tFormat'] == 0xFFFF:
-                if not self.spriteData:
-                    self.spriteData = [self.textures[i]]
-                    for tdat in self.textures:
-                        if tdat['tFormat'] != 0xFFFF:
-                            self.td = tdat
-                else:
-                    self.spriteData.append(self.textures[i])
-        if self.spriteData:
-            self.textureCount -= len(self.spriteData)
-            for i in range(len(self.spriteData)):
-                self.textures.remove(self.spriteData[i])
-                self.infile.seek(self.spriteData[i]['tOffset'])
-                self.spriteData[i]['shl'], self.spriteData[i]['sCount'] = unpack("<II", self.infile.read(8))
-                if self.spriteData[i]['shl'] != 8:
-                    print("Strange Sprite Header length %x for sprite %i" % (self.spriteData[i]['shl'], i))
-                    continue
-                else:
-                    self.spriteCount += 1
-                cb = []
-                self.dbs = 0
-                for j in range(self.spriteData[i]['sCount']):
-                    self.infile.seek(self.spriteData[i]['tOffset'] + j * 8 + 8)
-                    cb.append({})
-                    cb[j]['DBOffset'], cb[j]['u1'], cb[j]['bytes'], cb[j]['DBCount'] = unpack("<IBHB", self.infile.read(8))
-                    self.infile.seek(self.spriteData[i]['tOffset'] + cb[j]['DBOffset'])
-                    cb[j]['db'] = []
-                    mh = 0
-                    mw = 0
-                    self.dbs += cb[j]['DBCount']
-                    for k in range(cb[j]['DBCount']):
-                        d = TPL_DBlock(unpack("<BBHBB", self.infile.read(6)))
-                        if d.hShift + d.hrle > mw: mw = d.hShift + d.hrle
-                        if d.vShift + d.vrle > mh: mh = d.vShift + d.vrle
-                        cb[j]['db'].append(d)
-                    cb[j]['height'] = mh
-                    cb[j]['width'] = mw
-                self.spriteData[i]['cb'] = cb
-                
-    def extractAll(self, targetDir=None, filenameRoot=None):
-        print("%i textures and %i sprites" % (self.textureCount, self.spriteCount))
+        with instrument.stage("tpl.parse"):
+            self.textureCount, self.headerSize = unpack("<II", self.infile.read(8))
+            self.spriteCount = 0
+            self.textures = []
+            self.spriteData = None
+            self.td = None
+            self.textureCache = TPL_TextureCache(cacheSize)
+            for i in range(self.textureCount):
+                self.infile.seek(self.headerSize + i * 8)
+                self.textures.append(dict())
+                self.textures[i]['tInfoOffset'], self.textures[i]['pInfoOffset'] = unpack("<II", self.infile.read(8))
+                self.infile.seek(self.textures[i]['tInfoOffset'])
+                tInfo = unpack("<HHHHI", self.infile.read(12))
+                self.textures[i]['tHeight'] = tInfo[0]
+                self.textures[i]['tWidth'] = tInfo[1]
+                self.textures[i]['tFormat'] = tInfo[3] #tInfo[2] doesn't matter, I think
+                self.textures[i]['tUnknown'] = tInfo[2] # but writing keeps it
+                self.textures[i]['tOffset'] = tInfo[4]
+                if self.textures[i]['pInfoOffset'] != 0:
+                    self.infile.seek(self.textures[i]['pInfoOffset'])
+                    pInfo = dict()
+                    pInfo['colors'], pInfo['u'], pInfo['offset'] = unpack("<HHI", self.infile.read(8))
+                    self.infile.seek(pInfo['offset'])
+                    c = self.infile.read(pInfo['colors'] * 4) # colors are stored in BGRA format
+                    self.textures[i]['pInfo'] = pInfo
+                    self.textures[i]['paletteData'] = c # kept as stored, and used as is for PNGs
+                    self.textures[i]['palette'] = TPL_PaletteColors(c)
+                    self.textures[i]['lut'] = paletteLUT(c) # switched to RGBA once, for rgbaTexture and rgbaSprite
+                if self.textures[i]['tFormat'] == 0xFFFF:
+                    if not self.spriteData:
+                        self.spriteData = [self.textures[i]]
+                        for tdat in self.textures:
+                            if tdat['tFormat'] != 0xFFFF:
+                                self.td = tdat
+                    else:
+                        self.spriteData.append(self.textures[i])
+            if self.spriteData:
+                self.textureCount -= len(self.spriteData)
+                for i in range(len(self.spriteData)):
+                    self.textures.remove(self.spriteData[i])
+                    self.infile.seek(self.spriteData[i]['tOffset'])
+                    self.spriteData[i]['shl'], self.spriteData[i]['sCount'] = unpack("<II", self.infile.read(8))
+                    if self.spriteData[i]['shl'] != 8:
+                        instrument.event("tpl.warning", "Strange Sprite Header length %(shl)x for sprite %(sheet)i", shl=self.spriteData[i]['shl'], sheet=i)
+                        continue
+                    else:
+                        self.spriteCount += 1
+                    cb = []
+                    self.dbs = 0
+                    for j in range(self.spriteData[i]['sCount']):
+                        self.infile.seek(self.spriteData[i]['tOffset'] + j * 8 + 8)
+                        cb.append({})
+                        cb[j]['DBOffset'], cb[j]['u1'], cb[j]['bytes'], cb[j]['DBCount'] = unpack("<IBHB", self.infile.read(8))
+                        self.infile.seek(self.spriteData[i]['tOffset'] + cb[j]['DBOffset'])
+                        cb[j]['db'] = []
+                        mh = 0
+                        mw = 0
+                        self.dbs += cb[j]['DBCount']
+                        for k in range(cb[j]['DBCount']):
+                            d = TPL_DBlock(unpack("<BBHBB", self.infile.read(6)))
+                            if d.hShift + d.hrle > mw: mw = d.hShift + d.hrle
+                            if d.vShift + d.vrle > mh: mh = d.vShift + d.vrle
+                            cb[j]['db'].append(d)
+                        cb[j]['height'] = mh
+                        cb[j]['width'] = mw
+                    self.spriteData[i]['cb'] = cb
+
+    def extractAll(self, targetDir=None, filenameRoot=None, workers=None, level=6, atlas=False, manifest=None):
+        """Extracts every texture and sprite as PNGs, encoded and written by workers threads at zlib level.
+
+        atlas: write each sprite sheet as one packed image and manifest, see extractAtlas, instead of a PNG per sprite.
+        manifest: an arch.manifest.ExtractManifest of earlier extractions, to skip images whose texture, palette
+            and sprite data haven't changed. Saved when done."""
+        written = []
+        with PNGWriterPool(workers, level=level) as pool:
+            self._extractAll(targetDir, filenameRoot, pool, atlas, manifest, written)
+        if manifest is not None:
+            for member in written:
+                manifest.record(*member)
+            manifest.save()
+        instrument.event("tpl.done", "Done", file=self.TPLFileName)
+
+    def _extractAll(self, targetDir, filenameRoot, pool, atlas=False, manifest=None, written=None):
+        instrument.event("tpl.start", "%(textures)i textures and %(sprites)i sprites", file=self.TPLFileName, textures=self.textureCount, sprites=self.spriteCount)
         if not targetDir:
             targetDir = '.'
             if ((self.spriteCount > 0) and (self.textureCount + self.spriteCount > 1)) or (self.textureCount > 1):
                 targetDir = os.path.join(targetDir, self.TPLFileName.split('.')[0])
         os.makedirs(targetDir, exist_ok=True)
         if (self.spriteCount > 0 and self.textureCount > 1) or (self.spriteCount == 0):
-            print("Processing Textures")
+            instrument.event("tpl.stage", "Processing Textures", stage="textures")
             for i in range(self.textureCount):
                 if self.td == self.textures[i]: continue
                 if filenameRoot: filenameRoot = "%s_tex%i.png" % (filenameRoot, i)
-                self.extractTexture(i, filenameRoot, targetDir)
+                if manifest is not None:
+                    fn = filenameRoot or "%s_tex%i.png" % (self.TPLFileName.split('.')[0], i)
+                    member = self._member("tex%i" % i, self._ranges(self.textures[i]), [os.path.join(targetDir, fn)])
+                    if manifest.check(*member): continue
+                    written.append(member)
+                self.extractTexture(i, filenameRoot, targetDir, pool)
         if self.spriteCount > 0:
-            self.td['textureData'] = self.e_t(self.td)
-            print("Processing Sprites")
+            instrument.event("tpl.stage", "Processing Sprites", stage="sprites")
             for i in range(self.spriteCount):
                 if self.spriteData[i]['shl'] != 8:
-                    print("Skipping confusing sprite data")
+                    instrument.event("tpl.warning", "Skipping confusing sprite data", sheet=i)
+                    continue
+                if atlas:
+                    if manifest is not None:
+                        sheet = self.spriteData[i]
+                        ranges = [(sheet['tOffset'], 8 + 8 * sheet['sCount'])] + [(sheet['tOffset'] + c['DBOffset'], 6 * c['DBCount']) for c in sheet['cb']]
+                        fn = os.path.join(targetDir, "%s_atlas%i" % (self.TPLFileName.split('.')[0], i))
+                        member = self._member("atlas%i" % i, ranges + self._ranges(self.td), [fn + ".png", fn + ".json"])
+                        if manifest.check(*member): continue
+                        written.append(member)
+                    self.extractAtlas(None, targetDir, i)
                     continue
                 for j in range(self.spriteData[i]['sCount']):
                     if filenameRoot: filenameRoot = "%s_spr%i_%j.png" % (filenameRoot, i, j)
-                    self.extractSprite(j, filenameRoot, targetDir)
-            self.td.pop("textureData")
-        print("Done")
+                    if manifest is not None: # extractSprite always reads the first sheet
+                        c = self.spriteData[0]['cb'][j]
+                        fn = filenameRoot or "%s_spr%i.png" % (self.TPLFileName.split('.')[0], j)
+                        member = self._member("spr%i" % j, [(self.spriteData[0]['tOffset'] + c['DBOffset'], 6 * c['DBCount'])] + self._ranges(self.td), [os.path.join(targetDir, fn)])
+                        if manifest.check(*member): continue
+                        written.append(member)
+                    self.extractSprite(j, filenameRoot, targetDir, pool)
         
-    def extractTexture(self, texIndex, filename=None, targetDir='.'):
+    def _ranges(self, t):
+        """(offset, length) of the pixel data and palette of texture t in the file."""
+        ranges = [(t['tOffset'], t['tHeight'] * t['tWidth'] // (2 if t['tFormat'] == 4 else 1))]
+        if 'pInfo' in t:
+            ranges.append((t['pInfo']['offset'], t['pInfo']['colors'] * 4))
+        return ranges
+
+    def _member(self, key, ranges, outputs):
+        """Arguments for ExtractManifest.check and record, for an image made from ranges of the file."""
+        def crc():
+            c = 0
+            for offset, length in ranges:
+                c = crcRange(self.infile, offset, length, None, c)
+            return c
+        return self.fpath, key, ranges[0][0], sum(length for offset, length in ranges), outputs, crc
+
+    def extractTexture(self, texIndex, filename=None, targetDir='.', pool=None):
+        """Writes texture texIndex as a palette PNG, through pool (a graphics.pngout.PNGWriterPool) if given."""
         if texIndex >= len(self.textures):
             raise IndexError("texIndex outside of list range: %r" % texIndex)
         if not filename: filename = "%s_tex%i.png" % (self.TPLFileName.split('.')[0], texIndex)
-        img = png.Writer(self.textures[texIndex]['tWidth'], self.textures[texIndex]['tHeight'], None, False, False, 8, self.textures[texIndex]['palette'])
-        with open(os.path.join(targetDir, filename), "wb") as oot:
-            img.write_array(oot, self.e_t(texIndex))
+        t = self.textures[texIndex]
+        self._writePNG(pool, os.path.join(targetDir, filename), t['tWidth'], t['tHeight'], self.e_t(texIndex), t['paletteData'])
 
-    def extractSprite(self, spriteIndex, filename=None, targetDir='.'):
+    def extractSprite(self, spriteIndex, filename=None, targetDir='.', pool=None):
+        """Writes sprite spriteIndex as a palette PNG, through pool (a graphics.pngout.PNGWriterPool) if given."""
         if spriteIndex >= self.spriteData[0]['sCount']:
             raise IndexError("spriteIndex outside of list range: %r" % spriteIndex)
         if not filename: filename = "%s_spr%i.png" % (self.TPLFileName.split('.')[0], spriteIndex)
-        img = png.Writer(self.spriteData[0]['cb'][spriteIndex]['width'], self.spriteData[0]['cb'][spriteIndex]['height'], None, False, False, 8, self.td['palette'])
-        with open(os.path.join(targetDir, filename), "wb") as oot:
-            img.write_array(oot, self.e_s(spriteIndex))
+        s = self.spriteData[0]['cb'][spriteIndex]
+        self._writePNG(pool, os.path.join(targetDir, filename), s['width'], s['height'], self.e_s(spriteIndex), self.td['paletteData'])
+
+    def _writePNG(self, pool, path, width, height, pixels, palette):
+        instrument.event("tpl.image", path=path, width=width, height=height)
+        if pool is not None:
+            pool.submit(path, width, height, pixels, palette)
+        else:
+            writeIndexed(path, width, height, pixels, palette)
 
     def e_s(self, spr): #extract sprite, return array data
         si = 0 #precautionary
-        s = self.spriteData[si]['cb'][spr]
-        if "textureData" in self.td:
-            t = self.td['textureData']
+        t = self.e_t(self.td)
+        with instrument.stage("tpl.compose"):
+            return _compose(t, self.td['tWidth'], self.spriteData[si]['cb'][spr])
+
+    def e_ss(self, sprites=None, si=0): #extract several sprites, return list of array data
+        """Composes many cells of sprite sheet si in one call, decoding the backing texture once.
+
+        sprites: iterable of cell indices, defaults to every cell in the sheet."""
+        cb = self.spriteData[si]['cb']
+        if sprites is None: sprites = range(len(cb))
+        t = self.e_t(self.td)
+        with instrument.stage("tpl.compose"):
+            return [_compose(t, self.td['tWidth'], cb[spr]) for spr in sprites]
+
+    def e_atlas(self, si=0, width=None, padding=0): #extract sprite sheet as one image
+        """Composes every cell of sprite sheet si into one packed image, straight into its buffer.
+
+        width and padding as for graphics.atlas.packSkyline. Returns (pixels, width, height, rects),
+        rects being the (x, y, width, height) of each cell in the image."""
+        cb = self.spriteData[si]['cb']
+        positions, aWidth, aHeight = packSkyline([(c['width'], c['height']) for c in cb], width, padding)
+        t = self.e_t(self.td)
+        if numpy is not None and isinstance(t, numpy.ndarray):
+            pd = numpy.zeros(aWidth * aHeight, dtype=numpy.uint8)
         else:
-            t = self.e_t(self.td)
-        pd = []
-        for i in range(s['height'] * s['width']):
-            pd.append(0) 
-        for d in s['db']: #for each d block
-#            row = (d.readStart & 0xFC00) >> 7
- #           column = d.readStart & 0x03FF
-  #          y1 = row * self.td['tWidth']
-   #LOOK:         x1 = column % self.td['tWidth']
-            r = (d.row * self.td['tWidth']) + (d.column % self.td['tWidth'])
-            for y in range(d.vrle): #for each row to read
-                for x in range(d.hrle): # for each column to read
-                    tp = r + (y * self.td['tWidth']) + x
-                    if x + (d.column % self.td['tWidth']) >= self.td['tWidth']: 
-                        tp += self.td['tWidth'] * 8
-                    sp = (d.vShift + y) * s['width'] + (d.hShift + x)    
-                    assert tp < len(t), 'tp %i outside t %i range' % (tp, len(t))
-                    assert sp < len(pd), 'sp outside pd range' 
-                    pd[sp] = t[tp]
-        return pd
+            pd = bytearray(aWidth * aHeight)
+        with instrument.stage("tpl.compose"):
+            for c, (x, y) in zip(cb, positions):
+                if c['width'] and c['height']:
+                    _compose(t, self.td['tWidth'], c, pd, x, y, aWidth)
+        return pd, aWidth, aHeight, [(x, y, c['width'], c['height']) for c, (x, y) in zip(cb, positions)]
+
+    def extractAtlas(self, filename=None, targetDir='.', si=0, width=None, padding=0):
+        """Writes sprite sheet si as one PNG atlas, with a JSON manifest of where each cell went beside it.
+
+        Returns the manifest."""
+        if not filename: filename = "%s_atlas%i.png" % (self.TPLFileName.split('.')[0], si)
+        pd, aWidth, aHeight, rects = self.e_atlas(si, width, padding)
+        path = os.path.join(targetDir, filename)
+        writeIndexed(path, aWidth, aHeight, pd, self.td['paletteData'])
+        cells = []
+        for j, (c, (x, y, w, h)) in enumerate(zip(self.spriteData[si]['cb'], rects)):
+            blocks = [{"hShift": d.hShift, "vShift": d.vShift, "width": d.hrle, "height": d.vrle} for d in c['db']]
+            cells.append({"index": j, "x": x, "y": y, "width": w, "height": h, "blocks": blocks})
+        manifest = {"image": filename, "width": aWidth, "height": aHeight, "sheet": si, "padding": padding, "cells": cells}
+        with open(os.path.splitext(path)[0] + ".json", "w") as oot:
+            json.dump(manifest, oot, indent=1)
+        return manifest
+
+    def rgbaPalette(self, tex):
+        """Returns the palette of texture tex (index or dict) as flat RGBA bytes, as rgbaTexture uses it.
+
+        PNGs carry the palette as stored instead, as they always have."""
+        t = self.textures[tex] if tex.__class__ == (1).__class__ else tex
+        return t['lut'][:len(t['paletteData'])]
+
+    def rgbaTexture(self, tex, asArray=False):
+        """Returns texture tex (index or dict) as RGBA bytes, or a height x width x 4 array if asArray and NumPy is around."""
+        t = self.textures[tex] if tex.__class__ == (1).__class__ else tex
+        if 'lut' not in t:
+            raise ValueError("Texture has no palette")
+        return _shapeRGBA(expandRGBA(self.e_t(tex), t['lut'], asArray), t['tWidth'], t['tHeight'])
+
+    def rgbaSprite(self, spr, asArray=False):
+        """Returns sprite spr as RGBA bytes, or a height x width x 4 array if asArray and NumPy is around."""
+        s = self.spriteData[0]['cb'][spr]
+        return _shapeRGBA(expandRGBA(self.e_s(spr), self.td['lut'], asArray), s['width'], s['height'])
 
     def e_t(self, tex): #extract texture, return array data
+        """Returns the decoded texture tex, an index or one of the textures dicts, through textureCache."""
         if tex.__class__ == (1).__class__:
-            t = self.textures[tex]
-        else:
-            if "textureData" in tex: return tex.pop("textureData")
-            t = tex
-        pd = [] # pixel data
+            return self.textureCache.get(tex, lambda: self._decode(self.textures[tex]))
+        for i, t in enumerate(self.textures):
+            if t is tex:
+                return self.textureCache.get(i, lambda: self._decode(tex))
+        return self._decode(tex)
+
+    def _decode(self, t):
         bytes = t['tHeight'] * t['tWidth']
         den = 2 if (t['tFormat'] == 4) else 1
         #extraction
-        self.infile.seek(t['tOffset'])
-        td = unpack("<" + str(bytes//den) + "B", self.infile.read(bytes//den))
-        if t['tFormat'] == 4:
-            td = [item for sublist in [[m&0x0F, (m&0xF0)>>4] for m in td] for item in sublist] #split bytes and then flatten list
-        for j in range(t['tHeight']):
-            for k in range(t['tWidth']):
-                pd.append(td[((j//8) * (t['tWidth']//(16*den)) * (128*den)) + ((j%8) * (16*den)) + (k%(16*den)) + ((k//(16*den)) * (128*den))])
-        return pd
+        with instrument.stage("tpl.read"):
+            self.infile.seek(t['tOffset'])
+            data = self.infile.read(bytes//den)
+        instrument.count("tpl.textures")
+        with instrument.stage("tpl.deswizzle"):
+            if numpy is not None and _canDeswizzle(t['tWidth'], t['tHeight'], den, len(data)):
+                return _deswizzleArray(data, t['tWidth'], t['tHeight'], den)
+            return _deswizzleList(data, t['tWidth'], t['tHeight'], den)
 
     def info(self):
         pass
 
     @staticmethod
     def isTPL(infile):
-        #the issue here, since there's no marker for TPL files in them as Sting uses them, is how to identify
-        NotImplemented
+        """Detects whether infile is a TPL file, leaving infile where it was."""
+        return TPL_File.probe(*readPrefix(infile))
+
+    @staticmethod
+    def probe(prefix, size):
+        """Checks the first bytes of a file size bytes long for a plausible TPL header.
+
+        There's no marker in TPL files as Sting uses them, so this checks the texture table and the
+        first texture's info against the file size, as far as prefix reaches."""
+        if len(prefix) < 8:
+            return False
+        count, headerSize = unpack_from("<II", prefix)
+        if not 0 < count < 0x1000 or headerSize < 8 or headerSize + 8 * count > size:
+            return False
+        if headerSize + 8 <= len(prefix):
+            tInfoOffset, pInfoOffset = unpack_from("<II", prefix, headerSize)
+            if tInfoOffset < 8 or tInfoOffset + 12 > size or pInfoOffset + 8 > size:
+                return False
+            if tInfoOffset + 12 <= len(prefix):
+                height, width, u, tFormat, tOffset = unpack_from("<HHHHI", prefix, tInfoOffset)
+                den = 2 if tFormat == 4 else 1
+                if tOffset >= size or (tFormat != 0xFFFF and tOffset + height * width // den > size):
+                    return False
         return True
 
+    def addTexture(self, pixels, width, height, palette, tFormat=None, unknown=0):
+        """Adds a texture to a TPL being created, returns its index.
+
+        pixels: width*height palette indices, row by row, as bytes, a uint8 array or a list.
+        palette: flat bytes or a list of 4-tuples in stored (BGRA) order, as paletteData, 'palette' and extracted PNGs have it.
+        tFormat: 4 for 4bpp, anything else is 8bpp. Defaults to 4 if the palette has 16 colors or fewer, else 5."""
+        palette = paletteBytes(palette)
+        if tFormat is None:
+            tFormat = 4 if len(palette) <= 64 else 5
+        den = 2 if tFormat == 4 else 1
+        if len(palette) > (64 if den == 2 else 1024):
+            raise ValueError("%i colors is too many for a %ibpp texture" % (len(palette) // 4, 8 // den))
+        t = {'tWidth': width, 'tHeight': height, 'tFormat': tFormat, 'tUnknown': unknown,
+             'data': swizzle(pixels, width, height, den), 'paletteData': palette, 'palette': TPL_PaletteColors(palette),
+             'lut': paletteLUT(palette), 'pInfo': {'colors': len(palette) // 4, 'u': 0}}
+        self.textures.append(t)
+        self.textureCount += 1
+        return len(self.textures) - 1
+
+    def addPNG(self, path, tFormat=None, colors=None):
+        """Adds a PNG as a texture, see addTexture. Palette PNGs keep their palette as is, like extracted ones have it;
+        others are quantized to colors (by default 16 for 4bpp and 256 otherwise)."""
+        width, height, pixels, palette = readPNG(path)
+        if palette is None:
+            pixels, palette = quantize(pixels, colors or (16 if tFormat == 4 else 256))
+            palette = swapRedBlue(palette) # true RGBA, to be stored as BGRA
+        return self.addTexture(pixels, width, height, palette, tFormat)
+
+    def addSpriteSheet(self, cells):
+        """Adds a sprite sheet reading from the last texture added, cells being cb entries of another TPL_File's
+        spriteData, or lists of TPL_DBlocks."""
+        self._sheets.append([c if isinstance(c, dict) else {'db': list(c)} for c in cells])
+        self.spriteCount += 1
+
+    def finish(self):
+        """Writes out a TPL being created: the texture table, then each texture's info, palette info, palette and data."""
+        out = bytearray(pack("<II", len(self.textures) + len(self._sheets), 8))
+        out.extend(bytes(8 * (len(self.textures) + len(self._sheets))))
+        def align():
+            out.extend(bytes(-len(out) % 16))
+        for i, t in enumerate(self.textures):
+            align(); tInfo = len(out)
+            out.extend(bytes(12))
+            pInfo = 0
+            if t['paletteData']:
+                align(); pInfo = len(out)
+                out.extend(bytes(8))
+                align(); offset = len(out)
+                out.extend(t['paletteData'])
+                out[pInfo:pInfo + 8] = pack("<HHI", t['pInfo']['colors'], t['pInfo']['u'], offset)
+            align()
+            out[tInfo:tInfo + 12] = pack("<HHHHI", t['tHeight'], t['tWidth'], t['tUnknown'], t['tFormat'], len(out))
+            out.extend(t['data'])
+            out[8 + 8 * i:16 + 8 * i] = pack("<II", tInfo, pInfo)
+        for i, cells in enumerate(self._sheets, len(self.textures)):
+            align(); tInfo = len(out)
+            out.extend(bytes(12))
+            align(); base = len(out)
+            out[tInfo:tInfo + 12] = pack("<HHHHI", 0, 0, 0, 0xFFFF, base)
+            out.extend(pack("<II", 8, len(cells)) + bytes(8 * len(cells)))
+            for j, c in enumerate(cells):
+                out[base + 8 + 8 * j:base + 16 + 8 * j] = pack("<IBHB", len(out) - base, c.get('u1', 0), c.get('bytes', 0), len(c['db']))
+                for d in c['db']:
+                    out.extend(d.pack())
+            out[8 + 8 * i:16 + 8 * i] = pack("<II", tInfo, 0)
+        self.outfile.write(out)
+        self.outfile.close()
+        self.outfile = None
+
+    def save(self, path, replacements=None):
+        """Writes a copy of this TPL to path, with some textures' pixels and palettes replaced.
+
+        replacements: {texture index: PNG path, or (pixels, palette as addTexture takes it or None to keep it)}. Each
+        must be the texture's size, and fit its format and palette; truecolor PNGs are quantized to the palette's size.
+        Anything not replaced is copied as is, so unchanged textures come back byte for byte."""
+        self.infile.seek(0)
+        data = bytearray(self.infile.read())
+        for index, value in (replacements or {}).items():
+            t = self.textures[index]
+            den = 2 if t['tFormat'] == 4 else 1
+            colors = t['pInfo']['colors'] if 'pInfo' in t else 0
+            if isinstance(value, str):
+                width, height, pixels, palette = readPNG(value)
+                if (width, height) != (t['tWidth'], t['tHeight']):
+                    raise ValueError("%s is %ix%i, texture %i is %ix%i" % (value, width, height, index, t['tWidth'], t['tHeight']))
+                if palette is None:
+                    pixels, palette = quantize(pixels, colors or (16 if den == 2 else 256))
+                    palette = swapRedBlue(palette)
+            else:
+                pixels, palette = value
+            stored = swizzle(pixels, t['tWidth'], t['tHeight'], den)
+            data[t['tOffset']:t['tOffset'] + len(stored)] = stored
+            if palette is not None:
+                palette = paletteBytes(palette)
+                if len(palette) > 4 * colors:
+                    raise ValueError("Texture %i has room for %i colors, not %i" % (index, colors, len(palette) // 4))
+                data[t['pInfo']['offset']:t['pInfo']['offset'] + len(palette)] = palette # the rest stay as they were
+        with open(path, "wb") as oot:
+            oot.write(data)
+
     def close(self):
         if getattr(self, 'infile', None) is not None:
             self.infile.close()
         if getattr(self, 'outfile', None) is not None:
-            self.outfile.close()
+            self.finish()
     def __del__(self):
         self.close()
 
 
+def paletteLUT(palette):
+    """Makes a 256 entry RGBA lookup table, 1024 bytes, from a palette's BGRA bytes as stored.
+
+    Entries past the end of the palette are transparent black."""
+    lut = swapRedBlue(palette[:1024])
+    return lut + bytes(1024 - len(lut))
+
+def swapRedBlue(palette):
+    """Turns flat BGRA palette bytes into RGBA, or RGBA into BGRA."""
+    palette = paletteBytes(palette)
+    swapped = bytearray(palette)
+    swapped[0::4], swapped[2::4] = palette[2::4], palette[0::4]
+    return bytes(swapped)
+
+def expandRGBA(pixels, lut, asArray=False):
+    """Expands palette indices to RGBA through lut (see paletteLUT), with one translate or take per image.
+
+    Returns bytes, or an n x 4 uint8 array if pixels is an array or asArray is given and NumPy is around."""
+    if numpy is not None and (asArray or isinstance(pixels, numpy.ndarray)):
+        if not isinstance(pixels, numpy.ndarray):
+            pixels = numpy.frombuffer(bytes(pixels), dtype=numpy.uint8)
+        rgba = numpy.frombuffer(lut, dtype=numpy.uint8).reshape(256, 4)[pixels.reshape(-1)]
+        return rgba if asArray else rgba.tobytes()
+    indices = pixels if isinstance(pixels, (bytes, bytearray)) else bytes(pixels)
+    rgba = bytearray(4 * len(indices))
+    for c in range(4):
+        rgba[c::4] = indices.translate(lut[c::4])
+    return bytes(rgba)
+
+def _shapeRGBA(rgba, width, height):
+    return rgba.reshape(height, width, 4) if numpy is not None and isinstance(rgba, numpy.ndarray) else rgba
+
+def _compose(t, tWidth, s, out=None, x=0, y=0, stride=None):
+    """Copies each D-block of cell s out of the decoded texture t, a row (or 2D slice) at a time.
+
+    Columns running off the right edge of the texture continue 8 rows further down, as the flat
+    index arithmetic has always had them do. The cell goes into a new buffer of its own size, or
+    at (x, y) of out, a flat buffer stride pixels wide, if given. Returns the buffer."""
+    width, height = s['width'], s['height']
+    arrays = numpy is not None and isinstance(t, numpy.ndarray) and len(t) % tWidth == 0
+    if out is None:
+        out = numpy.zeros(height * width, dtype=numpy.uint8) if arrays else bytearray(height * width)
+        x, y, stride = 0, 0, width
+    arrays = arrays and isinstance(out, numpy.ndarray)
+    if arrays:
+        t2, pd2 = t.reshape(-1, tWidth), out.reshape(-1, stride)[y:y + height, x:x + width]
+    origin = y * stride + x
+    for d in s['db']: #for each d block
+        if not d.hrle or not d.vrle: continue
+        column = d.column % tWidth
+        head = min(d.hrle, tWidth - column) # columns before the wraparound
+        jump = tWidth * 8 if head < d.hrle else 0
+        last = (d.row + d.vrle - 1) * tWidth + column + d.hrle - 1 + jump
+        assert last < len(t), 'tp %i outside t %i range' % (last, len(t))
+        if arrays and d.hrle - head <= tWidth:
+            pd2[d.vShift:d.vShift + d.vrle, d.hShift:d.hShift + head] = t2[d.row:d.row + d.vrle, column:column + head]
+            if jump:
+                r = d.row + 9 # next row from the overflow, plus the 8 row jump
+                pd2[d.vShift:d.vShift + d.vrle, d.hShift + head:d.hShift + d.hrle] = t2[r:r + d.vrle, :d.hrle - head]
+            continue
+        for line in range(d.vrle): #for each row to read
+            tp = (d.row + line) * tWidth + column
+            sp = origin + (d.vShift + line) * stride + d.hShift
+            out[sp:sp + head] = t[tp:tp + head]
+            if jump:
+                out[sp + head:sp + d.hrle] = t[tp + head + jump:tp + d.hrle + jump]
+    return out
+
+def _canDeswizzle(width, height, den, length):
+    """Whether the texture is whole tiles of 16*den x 8 pixels, which the array path needs."""
+    return width % (16*den) == 0 and height % 8 == 0 and length * den == width * height
+
+def _deswizzleArray(data, width, height, den):
+    """NumPy deswizzle: returns a flat, contiguous uint8 array of width*height pixel indices."""
+    td = numpy.frombuffer(data, dtype=numpy.uint8)
+    if den == 2: #split bytes, low nibble first
+        nibbles = numpy.empty(td.size * 2, dtype=numpy.uint8)
+        nibbles[0::2] = td & 0x0F
+        nibbles[1::2] = td >> 4
+        td = nibbles
+    tw = 16 * den
+    # tiles are stored row-major as (tile row, tile column, y in tile, x in tile)
+    td = td.reshape(height // 8, width // tw, 8, tw).transpose(0, 2, 1, 3)
+    return numpy.ascontiguousarray(td).reshape(-1)
+
+def swizzle(pixels, width, height, den):
+    """Inverse of the deswizzle: packs width*height palette indices into 16*den x 8 tiles, two to a byte if den is 2."""
+    if not _canDeswizzle(width, height, den, width * height // den):
+        raise ValueError("Can only swizzle whole %ix8 tiles, not %ix%i" % (16 * den, width, height))
+    tw, ts = 16 * den, 128 * den # tile width, tile size
+    if numpy is not None:
+        pd = pixels if isinstance(pixels, numpy.ndarray) else numpy.frombuffer(bytes(pixels), dtype=numpy.uint8)
+        pd = pd.astype(numpy.uint8, copy=False).reshape(height // 8, 8, width // tw, tw)
+        td = numpy.ascontiguousarray(pd.transpose(0, 2, 1, 3)).reshape(-1)
+        if den == 2:
+            if td.size and td.max() > 15:
+                raise ValueError("4bpp textures can't have palette indices over 15")
+            td = td[0::2] | (td[1::2] << 4)
+        return td.tobytes()
+    pd = pixels if isinstance(pixels, (bytes, bytearray)) else bytes(pixels)
+    td = bytearray(width * height)
+    for j in range(height):
+        dst = (j//8) * (width//tw) * ts + (j%8) * tw
+        for k in range(0, width, tw):
+            td[dst:dst + tw] = pd[j * width + k:j * width + k + tw]
+            dst += ts
+    if den == 2:
+        if td and max(td) > 15:
+            raise ValueError("4bpp textures can't have palette indices over 15")
+        low, high = bytes(td[0::2]), bytes(td[1::2]) # nibbles don't carry into each other
+        return (int.from_bytes(low, "little") | int.from_bytes(high, "little") << 4).to_bytes(len(low), "little")
+    return bytes(td)
+
+def _deswizzleList(data, width, height, den):
+    """Pure Python deswizzle, used when NumPy isn't available or the texture isn't whole tiles. Returns bytes."""
+    td = data
+    if den == 2: #split bytes, low nibble first
+        td = bytearray(2 * len(data))
+        td[0::2] = data.translate(_lowNibbles)
+        td[1::2] = data.translate(_highNibbles)
+    if _canDeswizzle(width, height, den, len(data)):
+        tw, ts = 16 * den, 128 * den # tile width, tile size
+        pd = bytearray(width * height)
+        for j in range(height):
+            src = (j//8) * (width//tw) * ts + (j%8) * tw
+            for k in range(0, width, tw): # a tile's worth of the row at a time
+                pd[j * width + k:j * width + k + tw] = td[src:src + tw]
+                src += ts
+        return bytes(pd)
+    pd = [] # pixel data
+    for j in range(height):
+        for k in range(width):
+            pd.append(td[((j//8) * (width//(16*den)) * (128*den)) + ((j%8) * (16*den)) + (k%(16*den)) + ((k//(16*den)) * (128*den))])
+    return bytes(pd)
+
+_lowNibbles = bytes(m & 0x0F for m in range(256))
+_highNibbles = bytes(m >> 4 for m in range(256))
+
 if __name__=="__main__":
     pass
@@ -0,0 +1,86 @@
+"""Walks archives nested inside archives (AFS holding DARs holding GMPs and TPLs, and so on) without temporary files."""
+import os, sys
+from collections import namedtuple
+from arch.common import SliceFile, probeSize
+from arch.afs import AFS_File
+from arch.dar import DAR_File
+from arch.gmp import GMP_File
+import formats
+
+
+Leaf = namedtuple("Leaf", "path format data") # path through the archives joined with /, registry name or None, bytes-like
+_containers = {"afs": lambda f: AFS_File(f, mmap=True),
+               "dar": lambda f: DAR_File(file=f, mmap=True),
+               "gmp": lambda f: GMP_File(f, mmap=True)}
+
+
+def walk(path, kinds=None, maxDepth=16):
+    """Yields a Leaf for every non-archive file inside the archive at path, however deeply nested.
+
+    Members are opened in place from a mapping of the outermost file; only compressed DAR members
+    are decompressed into memory, so most leaves' data are memoryviews into the mapping.
+    kinds: format names (see formats.formats) to yield, None for everything including unknown files.
+    maxDepth: how many archives deep to go, anything deeper is yielded as a leaf."""
+    with open(path, "rb") as infile:
+        fmt = formats.identify(*_prefix(infile))
+        if fmt is None or fmt.name not in _containers:
+            if kinds is None or (fmt and fmt.name in kinds):
+                yield Leaf(os.path.basename(path), fmt and fmt.name, infile.read())
+            return
+        archive = _containers[fmt.name](infile)
+        yield from _walk(archive, os.path.basename(path), kinds, maxDepth)
+
+def extractLeaves(path, outputdirectory=None, kinds=None):
+    """Writes every leaf under the archive at path to outputdirectory, laid out by nested path. Returns the count."""
+    if outputdirectory is None:
+        outputdirectory = os.path.splitext(os.path.basename(path))[0] + "_leaves"
+    n = 0
+    for leaf in walk(path, kinds):
+        fn = os.path.join(outputdirectory, *leaf.path.split("/"))
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with open(fn, "wb") as oot:
+            oot.write(leaf.data)
+        n += 1
+    return n
+
+def _walk(archive, prefix, kinds, depth):
+    try:
+        for i in range(archive.fileCount):
+            name = "%s/%s" % (prefix, archive.memberName(i) or "%i" % i)
+            data = memberData(archive, i)
+            fmt = formats.identify(bytes(data[:probeSize]), len(data))
+            if fmt is not None and fmt.name in _containers and depth > 1:
+                try:
+                    inner = _containers[fmt.name](SliceFile(data, name))
+                except Exception: # the probe let through something that isn't an archive after all
+                    fmt = None
+                else:
+                    yield from _walk(inner, name, kinds, depth - 1)
+                    continue
+            if kinds is None or (fmt and fmt.name in kinds):
+                yield Leaf(name, fmt and fmt.name, data)
+    finally:
+        archive.close()
+
+def memberData(archive, i):
+    """Member i of an AFS, DAR or GMP archive, a view of the archive's mapping unless it had to be decompressed."""
+    if isinstance(archive, DAR_File) and archive.fileInfo[i]["compressed"]:
+        return archive.readMember(i)
+    return archive.memberView(i)
+
+def _prefix(infile):
+    prefix = infile.read(probeSize)
+    size = infile.seek(0, 2)
+    infile.seek(0)
+    return prefix, size
+
+
+if __name__=="__main__":
+    if len(sys.argv) < 2:
+        print("Usage: [python] %s archive [outputdirectory [format ...]]" % sys.argv[0])
+        sys.exit()
+    if len(sys.argv) == 2:
+        for leaf in walk(sys.argv[1]):
+            print("%-6s %10i %s" % (leaf.format or "?", len(leaf.data), leaf.path))
+    else:
+        print("%i files written" % extractLeaves(sys.argv[1], sys.argv[2], set(sys.argv[3:]) or None))
@@ -0,0 +1,445 @@
+"""Serves archive members and decoded TPL images over HTTP, from archives kept open between requests.
+
+Paths are relative to the root directory given:
+    GET /raw/<archive>/<member>             the member's bytes, with Range support. member is a name or an index.
+    GET /list/<archive>[/<member>]          JSON of an archive's member names, or a TPL's texture and sprite counts.
+    GET /tex/<tpl>[/<member>]/<i>.png       texture i of a TPL file, or of a TPL inside an archive, as a PNG.
+    GET /spr/<tpl>[/<member>]/<j>.png       sprite j of a TPL's first sprite sheet, likewise.
+HEAD works for all of them."""
+import os, sys, json, time, asyncio, argparse, threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+from arch.common import SliceFile, readPrefix
+from arch.afs import AFS_File
+from arch.dar import DAR_File
+from arch.gmp import GMP_File
+from graphics.tpl import TPL_File
+from graphics.pngout import encodeIndexed
+from nested import memberData
+import formats
+
+
+_openers = {AFS_File: lambda f: AFS_File(f, mmap=True),
+            DAR_File: lambda f: DAR_File(file=f, mmap=True),
+            GMP_File: lambda f: GMP_File(f, mmap=True),
+            TPL_File: lambda f: TPL_File(file=f)}
+_reasons = {200: "OK", 206: "Partial Content", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+            416: "Range Not Satisfiable", 500: "Internal Server Error"}
+_maxHeaderLines = 100
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=None, headers=()):
+        super().__init__(message or _reasons[status])
+        self.status, self.headers = status, list(headers)
+
+
+class _Entry:
+    """An open archive in an ArchivePool. A context manager releasing it when done with."""
+    __slots__ = ("pool", "obj", "stamp", "lock", "lastUse", "refs", "retired")
+    def __init__(self, pool, obj, stamp):
+        self.pool, self.obj, self.stamp = pool, obj, stamp
+        self.lock = threading.Lock() # archives seek a shared file, one user at a time
+        self.lastUse = time.monotonic()
+        self.refs = 1 # whoever opened it is using it
+        self.retired = False # out of the pool, closed when the last user releases it
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.pool.release(self)
+
+class ArchivePool:
+    """Open, indexed archives and TPLs by path (and member, for TPLs inside archives).
+
+    Files are reopened when their size or mtime changes. The least recently used are dropped past
+    maxOpen, and any left unused for idleTimeout seconds when evictIdle is called. Dropped entries
+    still in use are closed when the last user releases them."""
+    def __init__(self, maxOpen=64, idleTimeout=300.0):
+        self.maxOpen, self.idleTimeout = maxOpen, idleTimeout
+        self.opened = self.evicted = 0
+        self._entries = OrderedDict() # (path, member) -> _Entry
+        self._opening = {} # (path, member) -> lock held while opening it
+        self._lock = threading.Lock()
+    def acquire(self, path, member=None):
+        """Returns the entry for the archive at path, or the TPL at member of it, opening it if need be.
+
+        The entry stays open until released, use it as a context manager or call release. Use the
+        entry's obj only while holding its lock."""
+        stamp = _stamp(path)
+        key = (path, member)
+        entry = self._pin(key, stamp)
+        if entry is not None:
+            return entry
+        with self._lock:
+            opening = self._opening.setdefault(key, threading.Lock())
+        with opening: # one thread opens it, the others wait for it
+            try:
+                entry = self._pin(key, stamp)
+                if entry is not None:
+                    return entry
+                entry = _Entry(self, self._open(path, member), stamp)
+                with self._lock:
+                    old = self._entries.pop(key, None)
+                    self._entries[key] = entry
+                    self.opened += 1
+                    stale = [old] if old is not None else []
+                    while len(self._entries) > self.maxOpen:
+                        stale.append(self._entries.popitem(last=False)[1])
+                    stale = [e for e in stale if self._retire(e)]
+            finally:
+                with self._lock:
+                    self._opening.pop(key, None) # anyone still waiting finds the entry
+        for e in stale:
+            self._close(e)
+        return entry
+    def release(self, entry):
+        """Lets go of an entry from acquire, closing it if it has left the pool and nobody else is using it."""
+        with self._lock:
+            entry.refs -= 1
+            closing = entry.retired and entry.refs == 0
+        if closing:
+            self._close(entry)
+    def _pin(self, key, stamp):
+        """The entry under key if it's current, counted as in use, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.stamp != stamp:
+                return None
+            self._entries.move_to_end(key)
+            entry.lastUse = time.monotonic()
+            entry.refs += 1
+            return entry
+    def _open(self, path, member):
+        if member is None:
+            return _openFile(path)
+        with self.acquire(path) as outer, outer.lock:
+            if isinstance(outer.obj, TPL_File):
+                raise HTTPError(404, "%s isn't an archive" % os.path.basename(path))
+            i = _memberIndex(outer.obj, member)
+            data = bytes(memberData(outer.obj, i)) # a copy, so it outlives the outer archive
+        if not TPL_File.probe(data[:4096], len(data)):
+            raise HTTPError(404, "%s isn't a TPL file" % member)
+        return TPL_File(file=SliceFile(data, member))
+    def _retire(self, entry):
+        """Marks an entry taken out of the pool, under _lock. Returns whether it can be closed now."""
+        entry.retired = True
+        return entry.refs == 0
+    def evictIdle(self, now=None):
+        """Closes everything unused for idleTimeout seconds. Returns how many were closed."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            idle = [k for k, e in self._entries.items() if not e.refs and now - e.lastUse > self.idleTimeout]
+            stale = [self._entries.pop(k) for k in idle]
+            for e in stale:
+                self._retire(e)
+        for e in stale:
+            self._close(e)
+        return len(stale)
+    def _close(self, entry):
+        entry.obj.close()
+        self.evicted += 1
+    def close(self):
+        """Closes everything, entries still in use once they're released."""
+        with self._lock:
+            stale = [e for e in self._entries.values() if self._retire(e)]
+            self._entries.clear()
+        for e in stale:
+            self._close(e)
+    def __len__(self):
+        return len(self._entries)
+
+
+class ResponseCache:
+    """Encoded responses by key, least recently used dropped once they take more than maxBytes."""
+    def __init__(self, maxBytes=64 << 20):
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+    def put(self, key, body):
+        if len(body) > self.maxBytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = body
+            self.size += len(body)
+            while self.size > self.maxBytes:
+                self.size -= len(self._entries.popitem(last=False)[1])
+    def __len__(self):
+        return len(self._entries)
+
+
+class ArchiveServer:
+    """The HTTP front end: parses requests on the event loop, does all file work on an executor."""
+    def __init__(self, root, maxOpen=64, idleTimeout=300.0, cacheSize=64 << 20, workers=None, level=6):
+        """root: directory served, nothing outside it can be reached.
+        maxOpen, idleTimeout: see ArchivePool.
+        cacheSize: bytes of encoded PNGs to keep, see ResponseCache.
+        workers: threads reading and decoding.
+        level: zlib level PNGs are encoded at."""
+        self.root = os.path.realpath(root)
+        self.pool = ArchivePool(maxOpen, idleTimeout)
+        self.cache = ResponseCache(cacheSize)
+        self.level = level
+        self.executor = ThreadPoolExecutor(workers)
+        self.requests = 0
+        self._server = self._reaper = None
+
+    async def start(self, host="127.0.0.1", port=8080, unix=None):
+        """Starts listening on host:port, or on the Unix socket at unix. Returns the asyncio server."""
+        if unix is not None:
+            self._server = await asyncio.start_unix_server(self.handle, unix)
+        else:
+            self._server = await asyncio.start_server(self.handle, host, port)
+        self._reaper = asyncio.ensure_future(self._reap())
+        return self._server
+
+    async def close(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.pool.close)
+        self.executor.shutdown(wait=True)
+
+    async def _reap(self):
+        while True:
+            await asyncio.sleep(max(1.0, min(self.pool.idleTimeout / 2, 30.0)))
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.pool.evictIdle)
+
+    async def handle(self, reader, writer):
+        """Serves requests on one connection until either side closes it."""
+        try:
+            while True:
+                try:
+                    request = await self._readRequest(reader)
+                except HTTPError as e:
+                    await self._send(writer, e.status, str(e).encode() + b"\n", "text/plain", e.headers, close=True)
+                    break
+                if request is None:
+                    break
+                method, target, version, headers = request
+                close = version == "HTTP/1.0" or headers.get("connection", "").lower() == "close"
+                try:
+                    if method not in ("GET", "HEAD"):
+                        raise HTTPError(405, headers=[("Allow", "GET, HEAD")])
+                    status, body, contentType, extra = await asyncio.get_running_loop().run_in_executor(
+                        self.executor, self.respond, target, headers.get("range"))
+                except HTTPError as e:
+                    status, body, contentType, extra = e.status, str(e).encode() + b"\n", "text/plain", e.headers
+                    close = close or method not in ("GET", "HEAD") # whatever body it sent is still unread
+                except Exception as e:
+                    status, body, contentType, extra = 500, ("%s: %s\n" % (e.__class__.__name__, e)).encode(), "text/plain", []
+                self.requests += 1
+                await self._send(writer, status, body, contentType, extra, close, method == "HEAD")
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _readRequest(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, version = line.decode("latin-1").split()
+        except ValueError:
+            raise HTTPError(400, "Malformed request line")
+        headers = {}
+        for n in range(_maxHeaderLines + 1):
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                return method, target, version, headers
+            name, sep, value = line.decode("latin-1").partition(":")
+            if not sep:
+                raise HTTPError(400, "Malformed header")
+            headers[name.strip().lower()] = value.strip()
+        raise HTTPError(400, "Too many headers")
+
+    async def _send(self, writer, status, body, contentType, headers, close=False, head=False):
+        lines = ["HTTP/1.1 %i %s" % (status, _reasons[status]), "Content-Type: " + contentType,
+                 "Content-Length: %i" % len(body), "Connection: " + ("close" if close else "keep-alive")]
+        lines.extend("%s: %s" % h for h in headers)
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        if not head and len(body):
+            writer.write(body)
+        await writer.drain()
+
+    def respond(self, target, rangeHeader=None):
+        """Executor side: returns (status, body, content type, extra headers) for a request target."""
+        path = unquote(target.split("?", 1)[0])
+        route, _, rest = path.lstrip("/").partition("/")
+        if route == "raw":
+            return self._raw(rest, rangeHeader)
+        if route == "list":
+            return self._list(rest)
+        if route in ("tex", "spr"):
+            return self._image(route, rest)
+        raise HTTPError(404)
+
+    def _resolve(self, rest):
+        """Splits a path into (the file it starts with under root, the rest joined with /)."""
+        segments = [s for s in rest.split("/") if s]
+        path = self.root
+        for n, s in enumerate(segments):
+            if s in (".", ".."):
+                raise HTTPError(404)
+            path = os.path.join(path, s)
+            if os.path.isfile(path):
+                real = os.path.realpath(path)
+                if not real.startswith(self.root + os.sep):
+                    raise HTTPError(404)
+                return real, "/".join(segments[n + 1:])
+            if not os.path.isdir(path):
+                break
+        raise HTTPError(404, "No such file")
+
+    def _raw(self, rest, rangeHeader):
+        path, member = self._resolve(rest)
+        if not member:
+            raise HTTPError(404, "No member given")
+        with self.pool.acquire(path) as entry, entry.lock:
+            if isinstance(entry.obj, TPL_File):
+                raise HTTPError(404, "%s isn't an archive" % os.path.basename(path))
+            data = memberData(entry.obj, _memberIndex(entry.obj, member)) # a view keeps the mapping alive if the archive is closed
+        extra = [("Accept-Ranges", "bytes")]
+        span = _parseRange(rangeHeader, len(data))
+        if span is None:
+            return 200, data, "application/octet-stream", extra
+        start, end = span
+        extra.append(("Content-Range", "bytes %i-%i/%i" % (start, end - 1, len(data))))
+        return 206, data[start:end], "application/octet-stream", extra
+
+    def _list(self, rest):
+        path, member = self._resolve(rest)
+        with self.pool.acquire(path, member or None) as entry, entry.lock:
+            if isinstance(entry.obj, TPL_File):
+                t = entry.obj
+                info = {"format": "tpl", "textures": len(t.textures),
+                        "sprites": t.spriteData[0]['sCount'] if t.spriteCount else 0}
+            else:
+                info = {"format": entry.obj.__class__.__name__.split("_")[0].lower(), "members": list(entry.obj)}
+        return 200, json.dumps(info).encode(), "application/json", []
+
+    def _image(self, route, rest):
+        rest, _, last = rest.rpartition("/")
+        index = last[:-4] if last.endswith(".png") else last
+        if not index.isdigit():
+            raise HTTPError(404, "No image index given")
+        index = int(index)
+        path, member = self._resolve(rest)
+        with self.pool.acquire(path, member or None) as entry:
+            key = (route, path, member, index, entry.stamp)
+            body = self.cache.get(key)
+            if body is not None:
+                return 200, body, "image/png", []
+            with entry.lock:
+                t = entry.obj
+                if not isinstance(t, TPL_File):
+                    raise HTTPError(404, "%s isn't a TPL file" % (member or os.path.basename(path)))
+                if route == "tex":
+                    if not 0 <= index < len(t.textures):
+                        raise HTTPError(404, "No texture %i" % index)
+                    tex = t.textures[index]
+                    if 'paletteData' not in tex:
+                        raise HTTPError(404, "Texture %i has no palette" % index)
+                    size, pixels, palette = (tex['tWidth'], tex['tHeight']), t.e_t(index), tex['paletteData']
+                else:
+                    if not t.spriteCount or not 0 <= index < t.spriteData[0]['sCount']:
+                        raise HTTPError(404, "No sprite %i" % index)
+                    cell = t.spriteData[0]['cb'][index]
+                    size, pixels, palette = (cell['width'], cell['height']), t.e_s(index), t.td['paletteData']
+            body = encodeIndexed(size[0], size[1], pixels, palette, self.level)
+            self.cache.put(key, body)
+        return 200, body, "image/png", []
+
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        raise HTTPError(404, "No such file")
+    return st.st_size, st.st_mtime_ns
+
+def _openFile(path):
+    infile = open(path, "rb")
+    try:
+        fmt = formats.identify(*readPrefix(infile))
+        if fmt is None or fmt.cls not in _openers:
+            raise HTTPError(404, "%s isn't an archive or TPL file" % os.path.basename(path))
+        return _openers[fmt.cls](infile)
+    except BaseException:
+        infile.close()
+        raise
+
+def _memberIndex(archive, member):
+    """Looks a member up by name, then as an index."""
+    try:
+        return archive.memberIndex(member)
+    except KeyError:
+        if member.isdigit() and int(member) < archive.fileCount:
+            return int(member)
+    raise HTTPError(404, "No member %s" % member)
+
+def _parseRange(header, length):
+    """(start, end) of a single bytes range header, None for the whole thing. Raises 416 if it can't be met."""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None # multiple ranges are allowed to be answered with everything
+    first, sep, last = header[6:].strip().partition("-")
+    try:
+        if not first:
+            n = int(last)
+            if n <= 0: raise ValueError
+            start, end = max(0, length - n), length
+        else:
+            start = int(first)
+            end = int(last) + 1 if last else length
+            if last and end <= start: raise ValueError
+    except ValueError:
+        return None # malformed ranges are ignored
+    if start >= length:
+        raise HTTPError(416, headers=[("Content-Range", "bytes */%i" % length)])
+    return start, min(end, length)
+
+async def serve(root, host="127.0.0.1", port=8080, unix=None, **kwargs):
+    """Runs an ArchiveServer on root until cancelled. kwargs go to ArchiveServer."""
+    server = ArchiveServer(root, **kwargs)
+    listener = await server.start(host, port, unix)
+    try:
+        await listener.serve_forever()
+    finally:
+        await server.close()
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Serve archive members and TPL images over HTTP.")
+    parser.add_argument("root", help="directory of archives to serve")
+    parser.add_argument("-H", "--host", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=8080)
+    parser.add_argument("-u", "--unix", help="listen on this Unix socket instead")
+    parser.add_argument("-m", "--max-open", type=int, default=64, help="archives kept open, default 64")
+    parser.add_argument("-i", "--idle", type=float, default=300.0, help="seconds before an unused archive is closed, default 300")
+    parser.add_argument("-c", "--cache", type=int, default=64, help="MB of PNG responses cached, default 64")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="threads reading and decoding")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.root, args.host, args.port, args.unix, maxOpen=args.max_open, idleTimeout=args.idle,
+                          cacheSize=args.cache << 20, workers=args.workers))
+    except KeyboardInterrupt:
+        sys.exit()
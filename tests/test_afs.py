@@ -0,0 +1,68 @@
+from arch.afs import AFS_File
+from bench import fixtures
+
+
+def _write(path, files, u=None):
+    afs = AFS_File(create=path)
+    for i, (name, data) in enumerate(files):
+        afs.addFile(data, name, u[i] if u else (0, 0, 0, 0))
+    afs.close()
+
+def _contents(path):
+    with open(path, "rb") as f:
+        afs = AFS_File(f)
+        return [(afs.memberName(i), afs.readMember(i), afs.fileInfo[i]["u"]) for i in range(afs.fileCount)]
+
+
+def test_write_round_trips(tmp_path):
+    path, source = str(tmp_path / "x.afs"), str(tmp_path / "source.bin")
+    files = fixtures.members(5, 3000)
+    with open(source, "wb") as f:
+        f.write(files[4][1])
+    afs = AFS_File(create=path)
+    for i, (name, data) in enumerate(files[:4]):
+        afs.addFile(data, name, (i, 1, 2, 3))
+    afs.addFile(source, files[4][0])
+    afs.close()
+    assert _contents(path) == [(name, data, (i, 1, 2, 3) if i < 4 else (0, 0, 0, 0)) for i, (name, data) in enumerate(files)]
+    with open(path, "rb") as f:
+        afs = AFS_File(f)
+        assert all(afs.fileInfo[i]["dataOffset"] % 0x800 == 0 for i in range(afs.fileCount))
+
+def test_replace_in_place_and_relocating(tmp_path):
+    path = str(tmp_path / "x.afs")
+    files = [("a.bin", b"A" * 100), ("b.bin", b"B" * 100), ("c.bin", b"C" * 100)]
+    _write(path, files)
+    with open(path, "r+b") as f:
+        afs = AFS_File(f)
+        assert afs.replaceFile("a.bin", b"a" * 0x800)
+        assert not afs.replaceFile(1, b"b" * 0x801)
+        assert afs.replaceFile("c.bin", b"c" * 10, u=(4, 5, 6, 7))
+        assert afs.fileInfo[1]["dataOffset"] > afs.fileInfo[2]["dataOffset"]
+    assert _contents(path) == [("a.bin", b"a" * 0x800, (0, 0, 0, 0)), ("b.bin", b"b" * 0x801, (0, 0, 0, 0)), ("c.bin", b"c" * 10, (4, 5, 6, 7))]
+
+def test_last_member_grows_in_place(tmp_path):
+    path = str(tmp_path / "x.afs")
+    _write(path, [("a.bin", b"A" * 100), ("b.bin", b"B" * 100)], [(1, 2, 3, 4), (5, 6, 7, 8)])
+    with open(path, "r+b") as f:
+        afs = AFS_File(f)
+        offset = afs.fileInfo[1]["dataOffset"]
+        assert afs.replaceFile("b.bin", b"b" * 0x2000, u=(9, 9, 9, 9))
+        assert afs.fileInfo[1]["dataOffset"] == offset
+        assert afs.replaceFile(1, b"z" * 0x3000)
+    assert _contents(path) == [("a.bin", b"A" * 100, (1, 2, 3, 4)), ("b.bin", b"z" * 0x3000, (9, 9, 9, 9))]
+
+def test_shrinking_only_writes_the_new_size(tmp_path):
+    path = str(tmp_path / "x.afs")
+    _write(path, [("a.bin", b"A" * 0x1000), ("b.bin", b"B" * 100)])
+    with open(path, "rb") as f:
+        before = f.read()
+    with open(path, "r+b") as f:
+        afs = AFS_File(f)
+        offset = afs.fileInfo[0]["dataOffset"]
+        assert afs.replaceFile("a.bin", b"a" * 10)
+    with open(path, "rb") as f:
+        after = f.read()
+    assert after[offset:offset + 10] == b"a" * 10
+    assert after[offset + 10:offset + 0x1000] == before[offset + 10:offset + 0x1000] # the old tail is left alone
+    assert _contents(path) == [("a.bin", b"a" * 10, (0, 0, 0, 0)), ("b.bin", b"B" * 100, (0, 0, 0, 0))]
@@ -0,0 +1,15 @@
+import os
+import batch
+from bench import fixtures
+
+
+def test_gmp_repeated_names_plan_only_the_last(tmp_path):
+    path = str(tmp_path / "dup.gmp")
+    fixtures.makeGMP(path, [("a.bin", b"A" * 10), ("b.bin", b"B" * 5), ("a.bin", b"Z" * 7)])
+    jobs, failures = batch.planJobs([path], str(tmp_path / "out"), chunksize=1)
+    assert not failures
+    assert sorted(m for job in jobs for m in job[2]) == [1, 2]
+    for job in jobs:
+        batch._runJob(*job)
+    with open(os.path.join(jobs[0][3], "a.bin"), "rb") as f:
+        assert f.read() == b"Z" * 7
@@ -0,0 +1,60 @@
+import os
+from arch import instrument
+from arch.afs import AFS_File
+from arch.cache import ExtractCache
+from arch.dar import DAR_File
+from bench import fixtures
+
+
+def _extract(path, out, cache):
+    with open(path, "rb") as f:
+        AFS_File(f).extractFiles(out, cache=cache)
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_reextracting_over_hardlinked_outputs_keeps_cache_intact(tmp_path):
+    cache = ExtractCache(str(tmp_path / "cache"))
+    path, out = str(tmp_path / "x.afs"), str(tmp_path / "out")
+    fixtures.makeAFS(path, [("a.bin", b"A" * 100)])
+    _extract(path, out, cache)
+    fixtures.makeAFS(path, [("a.bin", b"Z" * 100)])
+    os.utime(path, ns=(1, 1))
+    _extract(path, out, cache)
+    other = str(tmp_path / "y.afs")
+    fixtures.makeAFS(other, [("a.bin", b"A" * 100)])
+    _extract(other, str(tmp_path / "other"), cache)
+    assert _read(str(tmp_path / "other" / "00000800_a.bin")) == b"A" * 100
+    assert _read(str(tmp_path / "out" / "00000800_a.bin")) == b"Z" * 100
+
+def test_hit_on_linked_output_leaves_nothing_behind(tmp_path):
+    cache = ExtractCache(str(tmp_path / "cache"))
+    path, out = str(tmp_path / "x.afs"), str(tmp_path / "out")
+    fixtures.makeAFS(path, fixtures.members(4, 100))
+    _extract(path, out, cache)
+    _extract(path, out, cache)
+    assert cache.hits == 4
+    assert not [n for n in os.listdir(out) if n.endswith(".cache-tmp")]
+
+def test_identical_members_of_another_build_hit_without_extracting(tmp_path):
+    files = fixtures.members(6, 200)
+    first, second = str(tmp_path / "a.dar"), str(tmp_path / "b.dar")
+    fixtures.makeDAR(first, files)
+    fixtures.makeDAR(second, files[:5] + [("new.bin", b"N" * 50)])
+    cache = ExtractCache(str(tmp_path / "cache"))
+    DAR_File(filename=first).extractFiles(str(tmp_path / "a"), cache=cache)
+    with instrument.Recorder() as rec:
+        DAR_File(filename=second).extractFiles(str(tmp_path / "b"), cache=cache)
+    assert (cache.hits, cache.misses) == (5, 7)
+    assert rec.counters["dar.members"] == 1
+    assert "dar.decompress" in rec.timers and rec.timers["dar.decompress"][0] == 1
+    for name, data in files[:5]:
+        matches = [n for n in os.listdir(str(tmp_path / "b")) if n.endswith("_" + name)]
+        assert _read(str(tmp_path / "b" / matches[0])) == data
+    reopened = ExtractCache(str(tmp_path / "cache"))
+    third = str(tmp_path / "c.dar")
+    fixtures.makeDAR(third, files[:1])
+    DAR_File(filename=third).extractFiles(str(tmp_path / "c"), cache=reopened)
+    assert reopened.hits == 1
@@ -0,0 +1,43 @@
+import os, random
+from arch.dar import DAR_File
+from bench import fixtures
+
+
+def test_write_round_trips(tmp_path):
+    files = fixtures.members(6, 5000)
+    noise = random.Random(1).randbytes(3000) # zlib can't shrink it, so it's stored
+    path = str(tmp_path / "x.dar")
+    dar = DAR_File(create=path)
+    for name, data in files[:3]:
+        dar.addFile(data, "dir/" + name)
+    dar.addFile(files[3][1], files[3][0], level=None)
+    dar.addFile(noise, "noise.bin")
+    dar.close()
+    dar = DAR_File(filename=path)
+    assert list(dar) == ["dir/" + name for name, data in files[:3]] + [files[3][0], "noise.bin"]
+    assert [dar[i] for i in range(len(dar))] == [data for name, data in files[:4]] + [noise]
+    assert [dar.fileInfo[i]["compressed"] for i in range(len(dar))] == [True, True, True, False, False]
+    assert all(dar.fileInfo[i]["fileOffset"] % 16 == 0 for i in range(len(dar)))
+    dar.close()
+
+def test_add_files_from_paths(tmp_path):
+    files = fixtures.members(12, 2000)
+    source = tmp_path / "source"
+    paths = []
+    for i, (name, data) in enumerate(files):
+        path = source / ("sub%i" % (i % 3)) / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        paths.append(str(path))
+    out = str(tmp_path / "x.dar")
+    dar = DAR_File(create=out)
+    dar.addFiles(paths, directory=str(source), levels=lambda name: None if name.startswith("sub0/") else 9, workers=2)
+    dar.close()
+    dar = DAR_File(filename=out)
+    assert list(dar) == ["sub%i/%s" % (i % 3, name) for i, (name, data) in enumerate(files)]
+    assert [not dar.fileInfo[i]["compressed"] for i in range(len(dar))] == [i % 3 == 0 for i in range(len(files))]
+    dar.extractFiles(str(tmp_path / "out"))
+    for i, (name, data) in enumerate(files):
+        directory = tmp_path / "out" / ("sub%i" % (i % 3))
+        assert (directory / ("%08X_%s" % (dar.fileInfo[i]["fileOffset"], name))).read_bytes() == data
+    dar.close()
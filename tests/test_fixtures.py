@@ -0,0 +1,14 @@
+from bench import fixtures
+from graphics.tpl import TPL_File
+
+
+def test_sprite_sheets_fit_their_texture(tmp_path):
+    path = str(tmp_path / "sheet.tpl")
+    for width, height in ((96, 16), (128, 64), (256, 1024)):
+        sheet = fixtures.spriteSheet(40, width, height)
+        fixtures.makeTPL(path, [(width, height, 5)], sheet)
+        t = TPL_File(filename=path)
+        # rows read back as written, none wrapped by the 6 bit row field
+        assert [d.row for c in t.spriteData[0]['cb'] for d in c['db']] == [block[2] for cell in sheet for block in cell]
+        assert len(t.e_ss()) == 40
+        t.close()
@@ -0,0 +1,51 @@
+import os
+import formats
+from arch.afs import AFS_File
+from arch.dar import DAR_File
+from arch.gmp import GMP_File
+from graphics.gim import GIM_File
+from graphics.tpl import TPL_File
+from bench import fixtures
+
+
+def _fixtures(tmp_path):
+    files = fixtures.members(5, 300)
+    paths = {}
+    paths[AFS_File] = str(tmp_path / "a.bin")
+    fixtures.makeAFS(paths[AFS_File], files)
+    paths[DAR_File] = str(tmp_path / "d.bin")
+    fixtures.makeDAR(paths[DAR_File], files)
+    paths[GMP_File] = str(tmp_path / "g.bin")
+    fixtures.makeGMP(paths[GMP_File], files)
+    paths[TPL_File] = str(tmp_path / "t.bin")
+    fixtures.makeTPL(paths[TPL_File], [(32, 16, 5), (64, 8, 4)])
+    paths[GIM_File] = str(tmp_path / "i.bin")
+    with open(paths[GIM_File], "wb") as f:
+        f.write(b"MIG.00.1PSP\x00" + bytes(100))
+    return paths
+
+
+def test_detect_by_content(tmp_path):
+    paths = _fixtures(tmp_path)
+    for cls, path in paths.items():
+        assert formats.detect(path) is cls, path
+    junk = str(tmp_path / "junk.bin")
+    with open(junk, "wb") as f:
+        f.write(b"\xff" * 64)
+    assert formats.detect(junk) is None
+    missing = str(tmp_path / "missing.bin")
+    assert formats.detect_many([paths[AFS_File], junk, missing], workers=2) == [(paths[AFS_File], AFS_File), (junk, None), (missing, None)]
+
+def test_probes_reject_tables_past_the_end(tmp_path):
+    paths = _fixtures(tmp_path)
+    for cls in (AFS_File, DAR_File, GMP_File, TPL_File):
+        with open(paths[cls], "rb") as f:
+            data = f.read()
+        assert cls.probe(data[:4096], len(data))
+        assert not cls.probe(data[:12], 12), cls # header but no table
+        assert not cls.probe(b"", 0)
+
+def test_probes_check_what_they_can_see():
+    assert not AFS_File.probe(b"AFX\0" + bytes(12), 16)
+    assert not GMP_File.probe((1).to_bytes(4, "little") + (16).to_bytes(4, "little") + bytes(8) + b"\x01\x02" + bytes(30), 48)
+    assert not formats.identify(bytes(16), 16)
@@ -0,0 +1,63 @@
+import os
+import pytest
+from arch import gmp, instrument
+from arch.gmp import GMP_File
+from bench import fixtures
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def _extract(tmp_path, files, mmap=False):
+    path, out = str(tmp_path / "x.gmp"), str(tmp_path / "out")
+    fixtures.makeGMP(path, files)
+    with open(path, "rb") as f, instrument.Recorder() as rec:
+        g = GMP_File(f, mmap=mmap)
+        g.extractFiles(out)
+        g.close()
+    for name, data in files:
+        assert _read(os.path.join(out, name)) == data
+    return rec
+
+
+@pytest.mark.parametrize("mmap", [False, True])
+def test_small_neighbours_are_read_together(tmp_path, mmap):
+    rec = _extract(tmp_path, fixtures.members(20, 1000), mmap)
+    assert rec.counters["gmp.reads"] == 1
+    assert rec.counters["gmp.members"] == 20
+
+def test_runs_stop_at_the_run_size(tmp_path, monkeypatch):
+    monkeypatch.setattr(gmp, "_runSize", 4096)
+    files = fixtures.members(20, 1000)
+    rec = _extract(tmp_path, files)
+    assert sum(len(data) for name, data in files) / 4096 <= rec.counters["gmp.reads"] < 20
+    assert rec.counters["gmp.members"] == 20
+
+@pytest.mark.parametrize("mmap", [False, True])
+def test_large_members_are_copied_between_runs(tmp_path, mmap):
+    files = fixtures.members(5, 500)
+    files[2] = ("large.bin", os.urandom(3 * gmp._smallSize))
+    rec = _extract(tmp_path, files, mmap)
+    assert rec.counters["gmp.reads"] == 2 # the small ones either side
+    assert rec.counters["gmp.members"] == 5
+    assert rec.counters["gmp.bytes"] == sum(len(data) for name, data in files)
+
+@pytest.mark.parametrize("failing", ["m0013.bin", "large.bin"])
+def test_writer_errors_stop_the_sweep(tmp_path, monkeypatch, failing):
+    monkeypatch.setattr(gmp, "_runSize", 2048)
+    files = fixtures.members(60, 1000) # more runs than the queue holds
+    files[30] = ("large.bin", bytes(2 * gmp._smallSize))
+    files[13] = ("m0013.bin", files[13][1])
+    createFile = gmp.createFile
+    def failingCreate(fn):
+        if os.path.basename(fn) == failing:
+            raise OSError("no room for " + fn)
+        return createFile(fn)
+    monkeypatch.setattr(gmp, "createFile", failingCreate)
+    path = str(tmp_path / "x.gmp")
+    fixtures.makeGMP(path, files)
+    with open(path, "rb") as f:
+        with pytest.raises(OSError, match=failing):
+            GMP_File(f).extractFiles(str(tmp_path / "out"))
+    assert not os.path.exists(str(tmp_path / "out" / files[-1][0])) # the reader stopped early
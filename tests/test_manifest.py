@@ -0,0 +1,41 @@
+import os
+import pytest
+import arch.afs, arch.dar, arch.gmp
+from arch.afs import AFS_File
+from arch.dar import DAR_File
+from arch.gmp import GMP_File
+from arch.manifest import ExtractManifest
+from bench import fixtures
+
+
+def _extract(kind, path, out, manifest):
+    if kind == "afs":
+        with open(path, "rb") as f:
+            AFS_File(f).extractFiles(out, manifest=manifest)
+    elif kind == "dar":
+        DAR_File(filename=path).extractFiles(out, manifest=manifest)
+    else:
+        with open(path, "rb") as f:
+            GMP_File(f).extractFiles(out, manifest=manifest)
+
+_makers = {"afs": fixtures.makeAFS, "dar": fixtures.makeDAR, "gmp": fixtures.makeGMP}
+_modules = {"afs": arch.afs, "dar": arch.dar, "gmp": arch.gmp}
+
+
+@pytest.mark.parametrize("kind", sorted(_makers))
+def test_crcs_are_worked_out_once(kind, tmp_path, monkeypatch):
+    path, out = str(tmp_path / ("x." + kind)), str(tmp_path / "out")
+    _makers[kind](path, fixtures.members(60, 300) + [("big.bin", bytes(200000))])
+    calls = []
+    crcRange = _modules[kind].crcRange
+    monkeypatch.setattr(_modules[kind], "crcRange", lambda *args: calls.append(args) or crcRange(*args))
+    manifest = ExtractManifest(str(tmp_path / "manifest.json"))
+    _extract(kind, path, out, manifest)
+    assert (manifest.extracted, len(calls)) == (61, 0) # summed while copying
+    os.utime(path, ns=(1, 1))
+    manifest = ExtractManifest(str(tmp_path / "manifest.json"))
+    _extract(kind, path, out, manifest)
+    assert (manifest.skipped, manifest.extracted, len(calls)) == (61, 0, 61) # each one checked against its CRC
+    manifest = ExtractManifest(str(tmp_path / "manifest.json"))
+    _extract(kind, path, out, manifest)
+    assert (manifest.skipped, len(calls)) == (61, 61) # and then a stat will do again
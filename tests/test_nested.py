@@ -0,0 +1,41 @@
+import os
+import nested
+from bench import fixtures
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def _tree(tmp_path):
+    """An AFS holding a loose file and a DAR, which holds a GMP, a TPL and a loose file."""
+    gmpFiles = fixtures.members(3, 200, seed=1)
+    fixtures.makeGMP(str(tmp_path / "inner.gmp"), gmpFiles)
+    fixtures.makeTPL(str(tmp_path / "inner.tpl"), [(32, 16, 5)])
+    darFiles = [("inner.gmp", _read(str(tmp_path / "inner.gmp"))), ("pic.tpl", _read(str(tmp_path / "inner.tpl"))), ("notes.txt", b"hello" * 20)]
+    fixtures.makeDAR(str(tmp_path / "inner.dar"), darFiles)
+    path = str(tmp_path / "outer.afs")
+    fixtures.makeAFS(path, [("loose.txt", b"loose" * 20), ("inner.dar", _read(str(tmp_path / "inner.dar")))])
+    return path, gmpFiles, darFiles
+
+
+def test_walk_yields_every_leaf(tmp_path):
+    path, gmpFiles, darFiles = _tree(tmp_path)
+    leaves = {leaf.path: (leaf.format, bytes(leaf.data)) for leaf in nested.walk(path)}
+    expected = {"outer.afs/loose.txt": (None, b"loose" * 20),
+                "outer.afs/inner.dar/pic.tpl": ("tpl", darFiles[1][1]),
+                "outer.afs/inner.dar/notes.txt": (None, b"hello" * 20)}
+    expected.update(("outer.afs/inner.dar/inner.gmp/" + name, (None, data)) for name, data in gmpFiles)
+    assert leaves == expected
+
+def test_walk_filters_and_stops(tmp_path):
+    path, gmpFiles, darFiles = _tree(tmp_path)
+    assert [leaf.path for leaf in nested.walk(path, kinds={"tpl"})] == ["outer.afs/inner.dar/pic.tpl"]
+    shallow = {leaf.path: leaf.format for leaf in nested.walk(path, maxDepth=1)}
+    assert shallow == {"outer.afs/loose.txt": None, "outer.afs/inner.dar": "dar"}
+
+def test_extract_leaves(tmp_path):
+    path, gmpFiles, darFiles = _tree(tmp_path)
+    out = str(tmp_path / "out")
+    assert nested.extractLeaves(path, out) == 6
+    assert _read(os.path.join(out, "outer.afs", "inner.dar", "inner.gmp", gmpFiles[0][0])) == gmpFiles[0][1]
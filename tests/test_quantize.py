@@ -0,0 +1,46 @@
+import random
+import pytest
+from graphics import quantize
+
+
+def _image(colors, pixels, seed=0):
+    rng = random.Random(seed)
+    palette = [bytes(rng.randrange(256) for _ in range(4)) for _ in range(colors)]
+    return b"".join(rng.choice(palette) for _ in range(pixels)), palette
+
+
+@pytest.fixture(params=["numpy", "pillow"])
+def backend(request, monkeypatch):
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        pytest.importorskip("PIL")
+        monkeypatch.setattr(quantize, "numpy", None)
+    return request.param
+
+
+def test_few_colors_are_kept_exactly(backend):
+    rgba, palette = _image(12, 500)
+    pixels, out = quantize.quantize(rgba, 16)
+    assert len(pixels) == 500 and len(out) <= 64
+    assert b"".join(out[4 * p:4 * p + 4] for p in pixels) == rgba
+    assert sorted(out[i:i + 4] for i in range(0, len(out), 4)) == sorted(set(palette))
+
+def test_many_colors_are_cut_down(backend):
+    rgba, palette = _image(300, 2000, seed=1)
+    pixels, out = quantize.quantize(rgba, 16)
+    assert len(pixels) == 2000 and 0 < len(out) <= 64
+    assert max(pixels) < len(out) // 4
+
+def test_median_cut_keeps_clusters_apart():
+    pytest.importorskip("numpy")
+    dark = [bytes((r, r, r, 255)) for r in range(0, 8)]
+    light = [bytes((r, r, r, 255)) for r in range(248, 256)]
+    rgba = b"".join(dark * 10 + light * 10)
+    pixels, out = quantize.quantize(rgba, 2)
+    assert len(out) == 8
+    assert len(set(pixels[:80])) == 1 and len(set(pixels[80:])) == 1 and pixels[0] != pixels[80]
+
+def test_partial_pixels_are_refused():
+    with pytest.raises(ValueError):
+        quantize.quantize(b"\0" * 6)
@@ -0,0 +1,26 @@
+import os, sys, subprocess
+from bench import fixtures
+
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _run(script, *args, cwd):
+    return subprocess.run([sys.executable, os.path.join(_root, script)] + list(args), cwd=cwd, capture_output=True, text=True)
+
+
+def test_modules_run_as_scripts(tmp_path):
+    for script in ("arch/afs.py", "arch/dar.py", "arch/gmp.py", "graphics/tpl.py"):
+        result = _run(script, cwd=str(tmp_path))
+        assert result.returncode == 0, result.stderr
+
+def test_gmp_script_extracts(tmp_path):
+    files = fixtures.members(3, 100)
+    fixtures.makeGMP(str(tmp_path / "x.gmp"), files)
+    result = _run("arch/gmp.py", "x.gmp", cwd=str(tmp_path))
+    assert result.returncode == 0, result.stderr
+    assert sorted(os.listdir(str(tmp_path / "x.gmp_files"))) == [name for name, data in files]
+    result = _run("arch/gmp.py", "v", "o", "out", "x.gmp", cwd=str(tmp_path))
+    assert result.returncode == 0, result.stderr
+    assert "Writing file file00000.bin" in result.stdout
+    assert sorted(os.listdir(str(tmp_path / "out"))) == [name for name, data in files]
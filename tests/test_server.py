@@ -0,0 +1,110 @@
+import os, json, random, asyncio, threading, http.client
+from struct import unpack_from
+import pytest
+from server import ArchiveServer
+from bench import fixtures
+
+
+_x = random.Random(2).randbytes(5000)
+_y = b"y" * 3000
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+@pytest.fixture
+def served(tmp_path):
+    """An ArchiveServer on localhost over an AFS, a DAR and a TPL with a sprite sheet, keeping one archive open."""
+    fixtures.makeTPL(str(tmp_path / "t.tpl"), [(64, 64, 5)], fixtures.spriteSheet(4, 64, 64))
+    fixtures.makeAFS(str(tmp_path / "a.afs"), [("x.bin", _x), ("pic.tpl", _read(str(tmp_path / "t.tpl")))])
+    fixtures.makeDAR(str(tmp_path / "d.dar"), [("dir/y.bin", _y)])
+    server = ArchiveServer(str(tmp_path), maxOpen=1, workers=8)
+    loop = asyncio.new_event_loop()
+    listener = loop.run_until_complete(server.start("127.0.0.1", 0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield server, listener.sockets[0].getsockname()[1]
+    asyncio.run_coroutine_threadsafe(server.close(), loop).result(10)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+def _get(port, target, headers={}, method="GET"):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    try:
+        connection.request(method, target, headers=headers)
+        response = connection.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        connection.close()
+
+def _pngSize(body):
+    assert body[:8] == b"\x89PNG\r\n\x1a\n" and body[12:16] == b"IHDR"
+    return unpack_from(">II", body, 16)
+
+
+def test_raw_members_and_ranges(served):
+    server, port = served
+    assert _get(port, "/raw/a.afs/x.bin")[::2] == (200, _x)
+    assert _get(port, "/raw/a.afs/0")[::2] == (200, _x)
+    assert _get(port, "/raw/d.dar/dir/y.bin")[::2] == (200, _y)
+    status, headers, body = _get(port, "/raw/a.afs/x.bin", {"Range": "bytes=100-199"})
+    assert (status, body, headers["Content-Range"]) == (206, _x[100:200], "bytes 100-199/5000")
+    assert _get(port, "/raw/a.afs/x.bin", {"Range": "bytes=-10"})[::2] == (206, _x[-10:])
+    assert _get(port, "/raw/a.afs/x.bin", {"Range": "bytes=4990-"})[::2] == (206, _x[4990:])
+    status, headers, body = _get(port, "/raw/a.afs/x.bin", {"Range": "bytes=5000-"})
+    assert (status, headers["Content-Range"]) == (416, "bytes */5000")
+    status, headers, body = _get(port, "/raw/a.afs/x.bin", method="HEAD")
+    assert (status, headers["Content-Length"], body) == (200, "5000", b"")
+
+def test_not_found(served):
+    server, port = served
+    for target in ("/raw/a.afs/nothing.bin", "/raw/a.afs", "/raw/missing.afs/x.bin", "/raw/../a.afs/x.bin",
+                   "/raw/t.tpl/0", "/tex/t.tpl/5.png", "/spr/t.tpl/99.png", "/tex/a.afs/x.bin/0.png", "/nowhere"):
+        assert _get(port, target)[0] == 404, target
+
+def test_images_and_lists(served):
+    server, port = served
+    status, headers, body = _get(port, "/tex/t.tpl/0.png")
+    assert (status, headers["Content-Type"], _pngSize(body)) == (200, "image/png", (64, 64))
+    assert _get(port, "/tex/a.afs/pic.tpl/0.png")[2] == body
+    assert _get(port, "/tex/t.tpl/0.png")[2] == body
+    assert server.cache.hits >= 1
+    status, headers, body = _get(port, "/spr/t.tpl/1.png")
+    assert status == 200 and _pngSize(body)[0] > 0
+    assert json.loads(_get(port, "/list/a.afs")[2]) == {"format": "afs", "members": ["x.bin", "pic.tpl"]}
+    assert json.loads(_get(port, "/list/a.afs/pic.tpl")[2]) == {"format": "tpl", "textures": 1, "sprites": 4}
+
+def test_eviction_under_concurrency(served):
+    server, port = served
+    failures = []
+    def hammer(n):
+        for i in range(200):
+            target, expected = ("/raw/a.afs/x.bin", _x) if (i + n) % 2 else ("/raw/d.dar/dir/y.bin", _y)
+            try:
+                status, body, contentType, extra = server.respond(target)
+                if (status, bytes(body)) != (200, expected):
+                    failures.append((target, status))
+            except Exception as e:
+                failures.append((target, e))
+    threads = [threading.Thread(target=hammer, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not failures
+    assert server.pool.evicted > 0 and len(server.pool) == 1
+    with server.pool.acquire(os.path.join(server.root, "a.afs")) as entry:
+        assert server.pool.evictIdle(now=float("inf")) == 0 # in use
+    assert server.pool.evictIdle(now=float("inf")) == 1
+    statuses = []
+    def fetch(n):
+        for i in range(20):
+            statuses.append(_get(port, "/raw/a.afs/x.bin" if (i + n) % 2 else "/raw/d.dar/dir/y.bin")[0])
+    threads = [threading.Thread(target=fetch, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert statuses == [200] * 160
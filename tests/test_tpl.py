@@ -0,0 +1,100 @@
+import pytest
+from graphics.tpl import TPL_File
+from bench import fixtures
+
+
+def _fixture(tmp_path, textures=((32, 16, 5), (64, 8, 4))):
+    path = str(tmp_path / "x.tpl")
+    fixtures.makeTPL(path, list(textures))
+    return path
+
+
+def test_rgba_output_switches_stored_bgra(tmp_path):
+    t = TPL_File(filename=_fixture(tmp_path))
+    for i, tex in enumerate(t.textures):
+        pixels, rgba, raw = t.e_t(i), t.rgbaTexture(i), tex['paletteData']
+        for p in range(len(pixels)):
+            b, g, r, a = raw[4 * int(pixels[p]):4 * int(pixels[p]) + 4]
+            assert rgba[4 * p:4 * p + 4] == bytes((r, g, b, a))
+        assert t.rgbaPalette(i) == b"".join(bytes((r, g, b, a)) for b, g, r, a in zip(raw[0::4], raw[1::4], raw[2::4], raw[3::4]))
+    t.close()
+
+def test_palette_stays_as_stored(tmp_path):
+    t = TPL_File(filename=_fixture(tmp_path))
+    for tex in t.textures:
+        raw = tex['paletteData']
+        colors = [tuple(raw[4 * c:4 * c + 4]) for c in range(len(raw) // 4)]
+        assert 'palette' in tex and tex.get('palette') == colors
+        assert list(tex['palette']) == colors and tex['palette'][-1] == colors[-1] and tex['palette'][1:3] == colors[1:3]
+    t.close()
+
+def test_pngs_keep_the_stored_palette(tmp_path):
+    png = pytest.importorskip("png")
+    t = TPL_File(filename=_fixture(tmp_path))
+    t.extractTexture(0, "t.png", str(tmp_path))
+    width, height, rows, info = png.Reader(filename=str(tmp_path / "t.png")).read()
+    assert [tuple(c) for c in info['palette']] == list(t.textures[0]['palette'])
+    assert [v for row in rows for v in row] == list(t.e_t(0))
+    t.close()
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def test_create_round_trips_byte_for_byte(tmp_path):
+    path = str(tmp_path / "sheet.tpl")
+    fixtures.makeTPL(path, [(32, 16, 5), (64, 64, 5)], fixtures.spriteSheet(6, 64, 64))
+    t = TPL_File(filename=path)
+    out = str(tmp_path / "new.tpl")
+    new = TPL_File(create=out)
+    for i, tex in enumerate(t.textures):
+        new.addTexture(t.e_t(i), tex['tWidth'], tex['tHeight'], tex['paletteData'], tex['tFormat'], tex['tUnknown'])
+    new.addSpriteSheet(t.spriteData[0]['cb'])
+    new.close()
+    t.close()
+    assert _read(out) == _read(path)
+
+def test_save_round_trips_byte_for_byte(tmp_path):
+    path = _fixture(tmp_path)
+    t = TPL_File(filename=path)
+    t.save(str(tmp_path / "copy.tpl"))
+    t.save(str(tmp_path / "same.tpl"), {i: (t.e_t(i), t.textures[i]['palette']) for i in range(t.textureCount)})
+    t.close()
+    assert _read(str(tmp_path / "copy.tpl")) == _read(path)
+    assert _read(str(tmp_path / "same.tpl")) == _read(path)
+
+def test_needs_something_to_open_or_create():
+    with pytest.raises(TypeError):
+        TPL_File()
+
+def test_add_png_round_trips_extracted_textures(tmp_path):
+    path = _fixture(tmp_path)
+    t = TPL_File(filename=path)
+    out = str(tmp_path / "new.tpl")
+    new = TPL_File(create=out)
+    for i, tex in enumerate(t.textures):
+        t.extractTexture(i, "%i.png" % i, str(tmp_path))
+        assert new.addPNG(str(tmp_path / ("%i.png" % i)), tex['tFormat']) == i
+    new.close()
+    t.save(str(tmp_path / "same.tpl"), {i: str(tmp_path / ("%i.png" % i)) for i in range(t.textureCount)})
+    t.close()
+    assert _read(out) == _read(path)
+    assert _read(str(tmp_path / "same.tpl")) == _read(path)
+
+def test_add_png_quantizes_truecolor(tmp_path):
+    png = pytest.importorskip("png")
+    t = TPL_File(filename=_fixture(tmp_path))
+    tex, rgba = t.textures[1], t.rgbaTexture(1)
+    with open(str(tmp_path / "rgba.png"), "wb") as f:
+        png.Writer(tex['tWidth'], tex['tHeight'], greyscale=False, alpha=True).write_array(f, rgba)
+    new = TPL_File(create=str(tmp_path / "new.tpl"))
+    new.addPNG(str(tmp_path / "rgba.png"), tex['tFormat'])
+    new.close()
+    back = TPL_File(filename=str(tmp_path / "new.tpl"))
+    assert back.textures[0]['pInfo']['colors'] <= 16
+    assert back.rgbaTexture(0) == rgba # 16 colors or fewer, so kept exactly
+    t.save(str(tmp_path / "same.tpl"), {1: str(tmp_path / "rgba.png")})
+    assert TPL_File(filename=str(tmp_path / "same.tpl")).rgbaTexture(1) == rgba
+    back.close()
+    t.close()